@@ -1,17 +1,50 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, abort, Response, g
+import os
+import sys
 import sqlite3
+from datetime import datetime
 from functools import wraps
 from werkzeug.security import check_password_hash
 
+# Share the main app's db package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from db.connection import ConnectionManager
+from db.snapshot import Snapshot
+from db.versions import bump_version
+from db import rollups
+from db.search import search_available, search_logs, highlight
+from db import export
+from services.ttl_cache import TTLCache
+
 # Configuration
 DB_PATH = "../db/dataset.db"  # Adjust path as needed
+# Reports read a copy of the database, refreshed once it is this many seconds old
+SNAPSHOT_PATH = "../db/dataset-snapshot.db"
+SNAPSHOT_MAX_AGE = int(os.getenv('ADMIN_SNAPSHOT_MAX_AGE', 300))
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this'
+app.add_template_filter(highlight)
+app.add_template_global(export.FORMATS, 'export_formats')
+
+connections = ConnectionManager(DB_PATH, row_factory=sqlite3.Row)
+
+# Row counts shown next to paged listings, keyed by their filters. A
+# minute-old total is close enough and saves a full scan per page.
+listing_counts = TTLCache(max_entries=256, ttl=60)
 
 def get_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    return connections.get()
+
+# Reporting routes read the snapshot, so their long queries stay off the live
+# database. Rollups are folded in before each copy, as that needs a write.
+reports = Snapshot(DB_PATH, SNAPSHOT_PATH, SNAPSHOT_MAX_AGE,
+                   row_factory=sqlite3.Row, prepare=rollups.catch_up)
+
+def get_report_connection():
+    conn = reports.get()
+    # Shown by base.html
+    g.snapshot_age = reports.age()
     return conn
 
 def admin_required(f):
@@ -69,7 +102,7 @@ def logout():
 @admin_required
 def dashboard():
     try:
-        conn = get_connection()
+        conn = get_report_connection()
         cursor = conn.cursor()
         
         # Total registered users
@@ -80,40 +113,21 @@ def dashboard():
         cursor.execute("SELECT COUNT(*) FROM subscriptions WHERE status = 'active'")
         active_subscriptions = cursor.fetchone()[0]
         
+        # Revenue and image counts come from the daily rollups, which are
+        # caught up whenever the snapshot is taken
+        cursor.execute("SELECT date('now'), date('now', 'start of month')")
+        today, month_start = cursor.fetchone()
+        
         # Total credits sold (from all transactions with amounts)
-        cursor.execute("SELECT SUM(amount) FROM transactions WHERE amount > 0")
-        total_credits_sold = cursor.fetchone()[0] or 0
+        total_credits_sold = rollups.totals(cursor)['revenue']
         
-        # Revenue this month - use ALL transactions with amounts (not just 'completed')
-        cursor.execute("""
-            SELECT SUM(amount) FROM transactions 
-            WHERE amount > 0 
-            AND created_at >= date('now', 'start of month')
-        """)
-        revenue_this_month = cursor.fetchone()[0] or 0
-        
-        # Alternative approach if the above doesn't work
-        if revenue_this_month == 0:
-            cursor.execute("""
-                SELECT SUM(amount) FROM transactions 
-                WHERE amount > 0 
-                AND strftime('%Y-%m', created_at) = strftime('%Y-%m', 'now')
-            """)
-            revenue_this_month = cursor.fetchone()[0] or 0
+        # Revenue and images this month - ALL transactions with amounts (not just 'completed')
+        this_month = rollups.totals(cursor, since=month_start)
+        revenue_this_month = this_month['revenue']
+        images_this_month = this_month['generations']
         
         # Images generated today
-        cursor.execute("""
-            SELECT COUNT(*) FROM generations 
-            WHERE DATE(created_at) = DATE('now')
-        """)
-        images_today = cursor.fetchone()[0]
-        
-        # Images generated this month
-        cursor.execute("""
-            SELECT COUNT(*) FROM generations 
-            WHERE created_at >= date('now', 'start of month')
-        """)
-        images_this_month = cursor.fetchone()[0]
+        images_today = rollups.totals(cursor, since=today)['generations']
         
         conn.close()
         
@@ -137,84 +151,86 @@ def users():
         # Get search parameters
         search = request.args.get('search', '').strip()
         subscription_status = request.args.get('subscription_status', '').strip()
-        page = request.args.get('page', 1, type=int)
+        # Keyset paging: "<created_at>|<id>" of the last user on the previous page
+        after = request.args.get('after', '')
+        after_created, _, after_id = after.rpartition('|')
         
         per_page = 20
-        offset = (page - 1) * per_page
         
-        conn = get_connection()
+        conn = get_report_connection()
         cursor = conn.cursor()
         
-        # Build the query with search conditions
+        # Build the query with search conditions; users.latest_subscription_id
+        # is kept pointing at each user's newest subscription
         base_query = """
             SELECT u.id, u.username, u.email, u.credits, u.created_at, u.verified,
                    s.plan_name, s.start_date, s.end_date, s.status as subscription_status
             FROM users u
-            LEFT JOIN (
-                SELECT user_id, plan_name, start_date, end_date, status,
-                       ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at DESC) as rn
-                FROM subscriptions
-            ) s ON u.id = s.user_id AND s.rn = 1
+            LEFT JOIN subscriptions s ON s.id = u.latest_subscription_id
         """
         
         count_query = """
             SELECT COUNT(*) 
             FROM users u
-            LEFT JOIN (
-                SELECT user_id, plan_name, start_date, end_date, status,
-                       ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at DESC) as rn
-                FROM subscriptions
-            ) s ON u.id = s.user_id AND s.rn = 1
+            LEFT JOIN subscriptions s ON s.id = u.latest_subscription_id
         """
         
         conditions = []
         params = []
-        count_params = []
         
         # Add search condition
         if search:
             conditions.append("(u.username LIKE ? OR u.email LIKE ? OR s.plan_name LIKE ?)")
             search_param = f'%{search}%'
             params.extend([search_param, search_param, search_param])
-            count_params.extend([search_param, search_param, search_param])
         
         # Add subscription status condition
         if subscription_status:
             if subscription_status == 'no_subscription':
-                conditions.append("s.user_id IS NULL")
+                conditions.append("u.latest_subscription_id IS NULL")
             else:
                 conditions.append("s.status = ?")
                 params.append(subscription_status)
-                count_params.append(subscription_status)
         
         # Apply conditions to queries
         if conditions:
-            where_clause = " WHERE " + " AND ".join(conditions)
-            base_query += where_clause
-            count_query += where_clause
+            count_query += " WHERE " + " AND ".join(conditions)
+        count_params = list(params)
+        
+        if after:
+            conditions.append("(u.created_at, u.id) < (?, ?)")
+            params.extend([after_created, int(after_id)])
+        
+        if conditions:
+            base_query += " WHERE " + " AND ".join(conditions)
         
         # Add ordering and pagination
-        base_query += " ORDER BY u.created_at DESC LIMIT ? OFFSET ?"
-        params.extend([per_page, offset])
+        base_query += " ORDER BY u.created_at DESC, u.id DESC LIMIT ?"
+        params.append(per_page + 1)
         
         # Execute the main query
         cursor.execute(base_query, params)
         users_data = cursor.fetchall()
         
-        # Execute count query for pagination
-        cursor.execute(count_query, count_params)
-        total_users = cursor.fetchone()[0]
+        # Total for the badge, recounted at most once a minute per filter
+        total_users = listing_counts.get(
+            ('users', search, subscription_status),
+            lambda: cursor.execute(count_query, count_params).fetchone()[0])
         
         conn.close()
         
-        total_pages = (total_users + per_page - 1) // per_page
+        next_after = None
+        if len(users_data) > per_page:
+            users_data = users_data[:per_page]
+            last = users_data[-1]
+            next_after = f"{last['created_at']}|{last['id']}"
         
         return render_template('admin/users.html', 
                              users=users_data,
                              search=search,
                              subscription_status=subscription_status,
-                             page=page,
-                             total_pages=total_pages,
+                             after=after,
+                             next_after=next_after,
                              total_users=total_users)
     except Exception as e:
         print(f"Users error: {e}")
@@ -227,94 +243,162 @@ def users():
 @admin_required
 def payments():
     try:
-        conn = get_connection()
+        # Keyset paging: "<created_at>|<id>" of the last payment on the previous page
+        after = request.args.get('after', '')
+        after_created, _, after_id = after.rpartition('|')
+        
+        per_page = 50
+        
+        conn = get_report_connection()
         cursor = conn.cursor()
         
-        cursor.execute("""
+        query = """
             SELECT t.id, t.user_id, u.email, t.plan_name, t.amount, t.status, 
                    t.payment_method, t.created_at, t.pid
             FROM transactions t
             JOIN users u ON t.user_id = u.id
-            ORDER BY t.created_at DESC
-        """)
+        """
+        params = []
+        if after:
+            query += " WHERE (t.created_at, t.id) < (?, ?)"
+            params.extend([after_created, int(after_id)])
+        query += " ORDER BY t.created_at DESC, t.id DESC LIMIT ?"
+        params.append(per_page + 1)
+        
+        cursor.execute(query, params)
         payments_data = cursor.fetchall()
         conn.close()
         
-        return render_template('admin/payments.html', payments=payments_data)
+        next_after = None
+        if len(payments_data) > per_page:
+            payments_data = payments_data[:per_page]
+            last = payments_data[-1]
+            next_after = f"{last['created_at']}|{last['id']}"
+        
+        return render_template('admin/payments.html',
+                             payments=payments_data,
+                             after=after,
+                             next_after=next_after)
     except Exception as e:
         print(f"Payments error: {e}")
         flash("Error loading payments data", "error")
         return render_template('admin/payments.html', payments=[])
 
+# Bulk exports, streamed as they are read
+@app.route('/export/<name>.<fmt>')
+@admin_required
+def export_table(name, fmt):
+    if name not in export.EXPORTS or fmt not in ('csv', 'parquet'):
+        abort(404)
+    if fmt not in export.FORMATS:
+        flash("Parquet export needs pyarrow installed", "error")
+        return redirect(request.referrer or url_for('payments'))
+    
+    date_from = request.args.get('date_from', '')
+    date_to = request.args.get('date_to', '')
+    
+    def generate():
+        conn = reports.get()
+        try:
+            # Plain tuples: less to build per row than sqlite3.Row
+            conn.row_factory = None
+            rows = export.batches(conn.cursor(), name, date_from, date_to)
+            if fmt == 'csv':
+                chunks = export.csv_chunks(name, rows)
+            else:
+                chunks = export.parquet_chunks(name, rows)
+            for chunk in chunks:
+                if chunk:
+                    yield chunk
+        except Exception as e:
+            print(f"Export error: {e}")
+            raise
+        finally:
+            conn.close()
+    
+    filename = f"{name}-{datetime.utcnow():%Y%m%d-%H%M%S}.{fmt}"
+    return Response(generate(), mimetype=export.FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
 # Image Generation Logs
 @app.route('/logs')
 @admin_required
 def logs():
     try:
-        page = request.args.get('page', 1, type=int)
-        search = request.args.get('search', '')
+        search = request.args.get('search', '').strip()
         date_from = request.args.get('date_from', '')
         date_to = request.args.get('date_to', '')
+        # Keyset paging: "<sort key>|<id>" of the last row of the previous page
+        after = request.args.get('after', '')
+        after_key, _, after_id = after.rpartition('|')
         
         per_page = 20
-        offset = (page - 1) * per_page
         
-        conn = get_connection()
+        conn = get_report_connection()
         cursor = conn.cursor()
         
-        query = """
-            SELECT g.id, g.user_id, u.email, g.prompt, g.aspect_ratio, g.created_at
-            FROM generations g
-            LEFT JOIN users u ON g.user_id = u.id
-        """
-        
-        conditions = []
-        params = []
-        
-        if search:
-            conditions.append("(u.email LIKE ? OR g.prompt LIKE ?)")
-            params.extend([f'%{search}%', f'%{search}%'])
-        
-        if date_from:
-            conditions.append("DATE(g.created_at) >= ?")
-            params.append(date_from)
-        
-        if date_to:
-            conditions.append("DATE(g.created_at) <= ?")
-            params.append(date_to)
-        
-        if conditions:
-            query += " WHERE " + " AND ".join(conditions)
-        
-        query += " ORDER BY g.created_at DESC LIMIT ? OFFSET ?"
-        params.extend([per_page, offset])
-        
-        cursor.execute(query, params)
-        logs_data = cursor.fetchall()
-        
-        count_query = "SELECT COUNT(*) FROM generations g LEFT JOIN users u ON g.user_id = u.id"
-        if conditions:
-            count_query += " WHERE " + " AND ".join(conditions)
-        
-        count_params = params[:-2]
-        cursor.execute(count_query, count_params)
-        total = cursor.fetchone()[0]
+        if search and search_available(cursor):
+            # Prompts through the full-text index, best matches first, then
+            # the generations of users whose email contains the search
+            logs_data = search_logs(cursor, search, per_page + 1,
+                                    after=(float(after_key), int(after_id)) if after else None,
+                                    date_from=date_from, date_to=date_to)
+            sort_key = 'rank'
+        else:
+            query = """
+                SELECT g.id, g.user_id, u.email, g.prompt, g.aspect_ratio, g.created_at
+                FROM generations g
+                LEFT JOIN users u ON g.user_id = u.id
+            """
+            
+            conditions = []
+            params = []
+            
+            if search:
+                conditions.append("(u.email LIKE ? OR g.prompt LIKE ?)")
+                params.extend([f'%{search}%', f'%{search}%'])
+            
+            if date_from:
+                conditions.append("g.created_at >= ?")
+                params.append(date_from)
+            
+            if date_to:
+                conditions.append("g.created_at < date(?, '+1 day')")
+                params.append(date_to)
+            
+            if after:
+                conditions.append("(g.created_at, g.id) < (?, ?)")
+                params.extend([after_key, int(after_id)])
+            
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            
+            query += " ORDER BY g.created_at DESC, g.id DESC LIMIT ?"
+            params.append(per_page + 1)
+            
+            cursor.execute(query, params)
+            logs_data = cursor.fetchall()
+            sort_key = 'created_at'
         
         conn.close()
         
-        total_pages = (total + per_page - 1) // per_page
+        next_after = None
+        if len(logs_data) > per_page:
+            logs_data = logs_data[:per_page]
+            last = logs_data[-1]
+            next_after = f"{last[sort_key]}|{last['id']}"
         
         return render_template('admin/logs.html', 
                              logs=logs_data, 
-                             page=page, 
-                             total_pages=total_pages,
+                             after=after,
+                             next_after=next_after,
                              search=search,
                              date_from=date_from,
                              date_to=date_to)
     except Exception as e:
         print(f"Logs error: {e}")
         flash("Error loading logs data", "error")
-        return render_template('admin/logs.html', logs=[], page=1, total_pages=1)
+        return render_template('admin/logs.html', logs=[])
     
 # Add this route to your existing routes
 @app.route('/settings')
@@ -385,6 +469,8 @@ def update_plan():
             SET name = ?, credits = ?, amount = ?, active = ?
             WHERE id = ?
         """, (name, credits_int, amount_float, active, plan_id))
+        # Tells the app's processes to reload their copy of the plans
+        bump_version(cursor, 'plans')
         
         conn.commit()
         conn.close()
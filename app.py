@@ -1,8 +1,22 @@
 import os
-from flask import Flask, abort, render_template, request, jsonify, session, redirect, url_for, flash, make_response
+from flask import Flask, abort, render_template, request, jsonify, session, redirect, url_for, flash, make_response, Response, stream_with_context, send_file
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import safe_join
 import requests
-from db.database import get_connection, init_db, get_user_by_id, get_generations_by_user_id, get_all_plans
+from db.database import get_connection, init_db, get_user_by_id, get_generations_by_user_id, search_generations_by_user_id, get_all_plans
+from db.credits import reserve_credit, release_credit, record as record_credit, PURCHASE, SUBSCRIPTION
+from db.jobs import new_job_id, create_job, cancel_job, get_job, get_followers, job_result, mark_refunded, update_progress, ATTACHED, RUNNING, DONE, FAILED, CANCELLED, FINISHED_STATES
+from services.dispatcher import JobDispatcher
+from services.router import InferenceRouter, parse_backends
+from services.inference import fetch_images, cancel_remote, endpoint_failed, JobDropped
+from services.result_cache import ResultCache, cache_key
+from services.persistence import GenerationWriter, private_copy
+from services.image_store import ImageStore, file_digest
+from services.temp_store import TempImageStore
+from services.resizer import ImageResizer, FORMATS as RESIZE_FORMATS
+from services.ttl_cache import TTLCache
+from services.versioned_cache import VersionedCache
+from PIL import Image
 import sqlite3
 import secrets
 import re
@@ -10,8 +24,11 @@ from datetime import datetime, timedelta
 from flask_mail import Mail, Message
 from authlib.integrations.flask_client import OAuth
 import time
+import shutil
+import tempfile
 from urllib.parse import unquote
 import json, base64, hmac, hashlib
+import mimetypes
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -53,37 +70,18 @@ def get_active_subscription(user_id):
     finally:
         conn.close()
 
-def deduct_credit(user_id):
-    """Deduct 1 credit, prioritizing subscription credits first"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    try:
-        # Try to deduct from subscription first
-        subscription = get_active_subscription(user_id)
-        if subscription:
-            cursor.execute("""
-                UPDATE subscriptions 
-                SET credits_remaining = credits_remaining - 1 
-                WHERE id = ? AND credits_remaining > 0
-            """, (subscription['id'],))
-            if cursor.rowcount == 1:
-                conn.commit()
-                return True
-        
-        # Fall back to user credits
-        cursor.execute("""
-            UPDATE users 
-            SET credits = credits - 1 
-            WHERE id = ? AND credits > 0
-        """, (user_id,))
-        if cursor.rowcount == 1:
-            conn.commit()
-            return True
-        
-        return False
-    finally:
-        conn.close()
+# Users and their active subscription, read by every page that shows credits.
+# Code that moves credits or changes an account calls forget_account();
+# ACCOUNT_CACHE_TTL bounds how stale other worker processes can be.
+account_cache = TTLCache(max_entries=int(os.environ.get('ACCOUNT_CACHE_SIZE', 1024)),
+                         ttl=int(os.environ.get('ACCOUNT_CACHE_TTL', 30)))
+
+def get_account(user_id):
+    """(user, active subscription) for `user_id`, from the account cache"""
+    return account_cache.get(user_id, lambda: (get_user_by_id(user_id), get_active_subscription(user_id)))
+
+def forget_account(user_id):
+    account_cache.invalidate(user_id)
 
 def sign_esewa_payload(total_amount: str, txn_uuid: str) -> str:
     message = (
@@ -130,10 +128,14 @@ google = oauth.register(
 )
 
 init_db()
+# Plans only change from the admin panel, which bumps their version; until it
+# does, each request just reads that counter.
+plans_cache = VersionedCache('plans', get_all_plans)
+
 # fetch plans data from database
 def get_plans():
     try:
-        return get_all_plans()
+        return plans_cache.get()
     except Exception as e:
         print(f"Error fetching plans: {e}")
         # Fallback to hardcoded values
@@ -142,7 +144,313 @@ def get_plans():
             "pro": {"credits": 150, "amount": 1000, "name": "Pro"}
         }
 COLAB_API = os.environ.get('COLAB_API_URL', 'https://7b6e2384fcbf.ngrok-free.app/generate')
-is_generating = False
+# COLAB_API_URL may list several endpoints ("url1|2,url2"); the optional |N is
+# how many jobs that endpoint runs at once, defaulting to GENERATION_CONCURRENCY.
+GENERATION_BACKENDS = parse_backends(COLAB_API, int(os.environ.get('GENERATION_CONCURRENCY', 1)))
+GENERATION_TIMEOUT = 120
+INFERENCE_HEADERS = {"ngrok-skip-browser-warning": "true"}
+# Jobs go to the least-loaded healthy endpoint; ones failing their /health
+# checks or jobs are taken out of rotation until they recover.
+router = InferenceRouter(GENERATION_BACKENDS, headers=INFERENCE_HEADERS,
+                         check_interval=int(os.environ.get('HEALTH_CHECK_INTERVAL', 10)))
+
+
+# "binary" streams PNGs from the inference server as length-prefixed frames;
+# "json" keeps the original base64-in-JSON responses.
+INFERENCE_WIRE_FORMAT = os.environ.get('INFERENCE_WIRE_FORMAT', 'binary').lower()
+GENERATED_FOLDER = os.path.join("static", "generated")
+INCOMING_FOLDER = os.path.join(GENERATED_FOLDER, ".incoming")
+# Generated images are served from /images/... rather than /static/...: files
+# in the content-addressed store are never rewritten (new content gets a new
+# name), so they are sent with validators and cached for good. Images saved
+# before the store existed can be, so browsers revalidate them after
+# LEGACY_IMAGE_MAX_AGE. Behind nginx, IMAGE_ACCEL_REDIRECT names an internal
+# location aliased to static/generated and nginx sends the bytes;
+# USE_X_SENDFILE does the same for Apache/lighttpd.
+IMAGES_URL = "/images"
+IMAGE_MAX_AGE = 365 * 24 * 3600
+LEGACY_IMAGE_MAX_AGE = 300
+IMAGE_ACCEL_REDIRECT = os.environ.get('IMAGE_ACCEL_REDIRECT')
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', 'False').lower() == 'true'
+
+GENERATION_MODEL = os.environ.get('GENERATION_MODEL', 'Lykon/dreamshaper-8')
+GENERATION_STEPS = 25
+# Deterministic-seed mode: when GENERATION_SEED is set every request uses that
+# seed, so identical requests give identical images and can be served from
+# the result cache instead of running inference again.
+GENERATION_SEED = os.environ.get('GENERATION_SEED')
+GENERATION_SEED = int(GENERATION_SEED) if GENERATION_SEED not in (None, '') else None
+# Generated images are stored once per distinct file, under their sha256
+image_store = ImageStore("static")
+result_cache = ResultCache(image_store, max_entries=int(os.environ.get('RESULT_CACHE_SIZE', 500)))
+# Guests have no library; their results are kept just long enough to view
+# and download them, outside static/ so they really do expire.
+guest_results = TempImageStore(
+    os.environ.get('GUEST_RESULTS_FOLDER', os.path.join(tempfile.gettempdir(), "pixtrix-guest")),
+    ttl=int(os.environ.get('GUEST_RESULTS_TTL', 900))
+)
+# Other sizes of library images (lightbox etc.), rendered on request by /img/<id>
+# and kept in a disk cache of RESIZE_CACHE_MB megabytes.
+resizer = ImageResizer(
+    os.environ.get('RESIZE_CACHE_FOLDER', os.path.join(tempfile.gettempdir(), "pixtrix-resized")),
+    max_bytes=int(os.environ.get('RESIZE_CACHE_MB', 256)) * 1024 * 1024,
+    workers=int(os.environ.get('RESIZE_WORKERS', 2))
+)
+
+
+# ----------- Generation Jobs -----------
+def image_url(image_path):
+    """Public URL of a stored image, given its path relative to static/"""
+    return f"{IMAGES_URL}/{image_path.removeprefix('generated/')}"
+
+
+app.add_template_global(image_url)
+
+
+def image_info(path, url):
+    """What the client gets for one image: where to load it and its size"""
+    with Image.open(path) as img:
+        width, height = img.size
+    return {"url": url, "width": width, "height": height}
+
+
+def cached_images(key):
+    """Fresh copies in INCOMING_FOLDER of the images cached under `key`, or None on a miss"""
+    cached = result_cache.lookup(key)
+    if not cached:
+        return None
+    os.makedirs(INCOMING_FOLDER, exist_ok=True)
+    paths = []
+    try:
+        for cached_path in cached:
+            fd, path = tempfile.mkstemp(dir=INCOMING_FOLDER, prefix='.incoming-', suffix='.png')
+            os.close(fd)
+            paths.append(path)
+            shutil.copyfile(cached_path, path)
+    except OSError as e:
+        print(f"Error copying cached generation: {e}")
+        discard_incoming(paths)
+        return None
+    return paths
+
+
+def fetch_job_images(job, backend):
+    """Run inference for a job on `backend`.
+
+    Returns paths of fresh files in INCOMING_FOLDER. Seeded results are
+    added to the result cache, which submit_generation checks first.
+    """
+    key = None
+    if job['seed'] is not None and result_cache.enabled:
+        key = job['request_key']
+
+    # Whatever is left of the job's time budget goes to the server, which
+    # drops the request once nobody is waiting for it any more
+    timeout = GENERATION_TIMEOUT
+    if job['deadline']:
+        timeout = job['deadline'] - time.time()
+        if timeout <= 0:
+            raise JobDropped("Job deadline passed before it reached the GPU")
+
+    payload = {
+        "job_id": job['id'],
+        "timeout": timeout,
+        "prompt": job['prompt'],
+        "negative_prompt": job['negative_prompt'],
+        "guidance_scale": job['guidance_scale'],
+        "aspect": job['aspect'],
+        "num_inference_steps": job['steps'] or GENERATION_STEPS
+    }
+    if job['seed'] is not None:
+        payload["seed"] = job['seed']
+
+    def on_progress(event):
+        update_progress(job['id'], event.get('step'), event.get('total'), event.get('previews'))
+
+    paths = fetch_images(backend.url, payload, INCOMING_FOLDER, timeout,
+                         binary=INFERENCE_WIRE_FORMAT == "binary", headers=INFERENCE_HEADERS,
+                         http=backend.session, on_progress=on_progress)
+    if key and paths:
+        try:
+            result_cache.store(key, paths)
+        except Exception as e:
+            print(f"Error caching generation: {e}")
+    return paths
+
+
+def deliver_job_images(job, paths, finish, fail):
+    """Dispatcher hook: give one job its own copy of the generated images"""
+    # Guests only get short-lived links, nothing is kept
+    if not job['user_id']:
+        finish({"images": [image_info(path, f"/results/{guest_results.put(path)}")
+                           for path in paths]})
+        return
+
+    # Save to DB for logged-in users. The writer thread moves the files into
+    # place and records them in one batch; the job is only done once that
+    # is committed, so its images are in the library when the user sees them.
+    files, rows, images = [], [], []
+    for path in paths:
+        digest = file_digest(path)
+        image_path = image_store.relative_path(digest)
+        info = image_info(path, image_url(image_path))
+        files.append((private_copy(path, job['id'][:8]), digest))
+        rows.append((job['user_id'], job['prompt'], image_path, job['aspect'], info['width'], info['height']))
+        images.append(info)
+    generation_writer.submit(files, rows, on_done=lambda: finish({"images": images}), on_error=fail)
+
+
+def discard_incoming(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def refund_job_credit(job):
+    """Return the credit reserved for a failed or cancelled job of a logged-in user (once)"""
+    if job['user_id'] and release_credit(job['id']):
+        mark_refunded(job['id'])
+        forget_account(job['user_id'])
+
+
+# Library thumbnails are encoded after the images are stored, by
+# THUMBNAIL_WORKERS threads of their own
+generation_writer = GenerationWriter(image_store, INCOMING_FOLDER,
+                                     render_workers=int(os.environ.get('THUMBNAIL_WORKERS', 1)))
+dispatcher = JobDispatcher(router, fetch_job_images, deliver_job_images,
+                           cleanup=discard_incoming, on_failure=refund_job_credit,
+                           lease_seconds=GENERATION_TIMEOUT + 60,
+                           retry_on=(requests.ConnectionError,), blame=endpoint_failed)
+
+
+@app.before_request
+def start_dispatcher():
+    dispatcher.start()
+
+
+def cancel_generation(job_id):
+    """Cancel a job nobody is waiting for and stop its inference.
+
+    Users get their credit back right away; guests get theirs in
+    settle_job, which has their session. Returns the row from before the
+    cancel, or None if the job had already finished.
+    """
+    job = cancel_job(job_id)
+    if not job:
+        return None
+    refund_job_credit(job)
+    # Jobs with followers keep running so the followers still get images
+    if job['status'] == RUNNING and job['backend'] and not get_followers(job_id):
+        backend = router.get(job['backend'])
+        cancel_remote(job['backend'], job_id, headers=INFERENCE_HEADERS,
+                      http=backend.session if backend else requests)
+    return job
+
+
+def submit_generation(prompt, aspect):
+    """Charge one credit for the current visitor and queue a generation job.
+
+    Returns (job_id, None) on success or (None, error_response) when the
+    visitor has no credits left.
+    """
+    options = dict(negative_prompt="blury", guidance_scale=7.5,
+                   steps=GENERATION_STEPS, seed=GENERATION_SEED)
+    # Identical requests in flight at the same time share one inference run
+    request_key = cache_key(prompt, options['negative_prompt'], options['guidance_scale'],
+                            aspect, options['steps'], options['seed'], GENERATION_MODEL)
+    deadline = time.time() + GENERATION_TIMEOUT
+    # A cached result is delivered right here, without a trip through the
+    # GPU queue. Such a job starts out running and takes no followers;
+    # identical requests find the cache too.
+    cached = None
+    if options['seed'] is not None and result_cache.enabled:
+        cached = cached_images(request_key)
+    job_options = dict(options, deadline=deadline)
+    if cached:
+        job_options['lease_seconds'] = GENERATION_TIMEOUT
+    else:
+        job_options['request_key'] = request_key
+
+    if 'user_id' in session:
+        user_id = session['user_id']
+        job_id = new_job_id()
+        # The credit is committed when the job is done, released if it fails
+        subscription_id = reserve_credit(user_id, job_id)
+        forget_account(user_id)
+        if subscription_id is False:
+            discard_incoming(cached or [])
+            return None, (jsonify(error="You don't have enough credits to generate images."), 403)
+        try:
+            create_job(prompt, aspect, user_id=user_id, subscription_id=subscription_id,
+                       job_id=job_id, **job_options)
+        except Exception:
+            release_credit(job_id)
+            discard_incoming(cached or [])
+            raise
+    else:
+        # --- Guest Credit Check ---
+        if 'guest_credits' not in session:
+            session['guest_credits'] = 2
+
+        if session['guest_credits'] <= 0:
+            discard_incoming(cached or [])
+            return None, (jsonify(error="You have used all your free credits. Please log in to continue."), 403)
+
+        session['guest_credits'] -= 1
+        if 'guest_token' not in session:
+            session['guest_token'] = secrets.token_hex(16)
+        job_id = create_job(prompt, aspect, guest_token=session['guest_token'], **job_options)
+
+    if cached:
+        dispatcher.complete(get_job(job_id), cached)
+    else:
+        dispatcher.notify()
+    return job_id, None
+
+
+def get_own_job(job_id):
+    """Load a job if it belongs to the current user or guest session"""
+    job = get_job(job_id)
+    if not job:
+        return None
+    if job['user_id']:
+        return job if job['user_id'] == session.get('user_id') else None
+    return job if job['guest_token'] and job['guest_token'] == session.get('guest_token') else None
+
+
+def settle_job(job):
+    """Build the client payload for a job, returning credits if it failed"""
+    payload = {"job_id": job['id'], "status": job['status']}
+    if job['status'] == DONE:
+        payload.update(job_result(job))
+    elif job['status'] in (FAILED, CANCELLED):
+        if job['user_id']:
+            refund_job_credit(job)
+        elif mark_refunded(job['id']):
+            # Rollback credit deduction for guests
+            session['guest_credits'] = session.get('guest_credits', 0) + 1
+        if job['status'] == CANCELLED:
+            payload['error'] = "The generation was cancelled."
+        else:
+            payload['error'] = "An error occurred while generating images."
+    return payload
+
+
+def wait_for_job(job_id, timeout=GENERATION_TIMEOUT):
+    """Block until a job finishes or `timeout` seconds pass.
+
+    A job still unfinished by then is cancelled, so the GPU stops working on
+    it and its credit is returned. Returns the last row seen.
+    """
+    deadline = time.time() + timeout
+    job = get_job(job_id)
+    while job['status'] not in FINISHED_STATES and time.time() < deadline:
+        time.sleep(0.5)
+        job = get_job(job_id)
+    if job['status'] not in FINISHED_STATES:
+        cancel_generation(job_id)
+        job = get_job(job_id)
+    return job
 
 
 # ----------- Helper Functions for getting First letters of User Name -----------
@@ -176,50 +484,17 @@ def index():
     if 'user_id' in session:
         return redirect(url_for('home'))
 
-    global is_generating
-    images = []
-
     if request.method == "POST":
-        # --- Guest Credit Check ---
-        if 'guest_credits' not in session:
-            session['guest_credits'] = 2
+        job_id, error = submit_generation(request.form["prompt"], request.form["aspect"])
+        if error:
+            return error
 
-        if session['guest_credits'] <= 0:
-            return jsonify(error="You have used all your free credits. Please log in to continue."), 403
-        
-        session['guest_credits'] -= 1
-        # --- End Credit Check ---
-
-        if is_generating:
-            return jsonify(error="Generation already in progress"), 429
-
-        is_generating = True
-        prompt = request.form["prompt"]
-        aspect = request.form["aspect"]
-        headers = {"ngrok-skip-browser-warning": "true"}
-
-        try:
-            r = requests.post(COLAB_API, json={
-                "prompt": prompt,
-                "negative_prompt": "blury",
-                "guidance_scale": 7.5,
-                "aspect": aspect
-            }, headers=headers, timeout=120)
-            r.raise_for_status()
-            data = r.json()
-            base64_strings = data.get("images", [])
-            images = ["data:image/png;base64," + s for s in base64_strings]
-
-        except Exception as e:
-            print(f"Error generating images: {e}")
-            # Rollback credit deduction for guests
-            session['guest_credits'] += 1
-            images = []
-        finally:
-            is_generating = False
+        payload = settle_job(wait_for_job(job_id))
+        if payload['status'] == CANCELLED:
+            return jsonify(error="Generation is taking longer than expected.", job_id=job_id), 504
 
         # build the JSON response
-        resp = jsonify(images=images)
+        resp = jsonify(images=payload.get("images", []))
 
         # mark browser as used for guests
         if not session.get('user_id'):
@@ -420,6 +695,7 @@ def send_verification_code():
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
     if cursor.fetchone():
+        conn.close()
         return jsonify(success=False, message="Email already registered")
 
     cursor.execute('SELECT created_at FROM verification_codes WHERE email = ? ORDER BY created_at DESC LIMIT 1', (email,))
@@ -427,6 +703,7 @@ def send_verification_code():
     if last_code_time:
         last_created_at = datetime.strptime(last_code_time[0], '%Y-%m-%d %H:%M:%S')
         if datetime.utcnow() - last_created_at < timedelta(seconds=60):
+            conn.close()
             return jsonify(success=False, message="Please wait 60 seconds before requesting a new code.")
 
     code = ''.join(secrets.choice('0123456789') for _ in range(6))
@@ -437,6 +714,7 @@ def send_verification_code():
         VALUES (?, ?, ?)
     ''', (email, code, expires_at))
     conn.commit()
+    conn.close()
 
     try:
         msg = Message("Your Verification Code", sender=app.config['MAIL_USERNAME'], recipients=[email])
@@ -454,8 +732,7 @@ def add_credits():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    user = get_user_by_id(session['user_id'])
-    active_sub = get_active_subscription(session['user_id'])
+    user, active_sub = get_account(session['user_id'])
     
     return render_template(
         "Add_Credits.html", 
@@ -471,6 +748,187 @@ def gallery_all():
     return render_template("gallery_all.html")
 
 
+# ======= Generation Jobs API =======
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    prompt = request.form.get("prompt", "").strip()
+    aspect = request.form.get("aspect", "square")
+    if not prompt:
+        return jsonify(error="Prompt is required."), 400
+
+    job_id, error = submit_generation(prompt, aspect)
+    if error:
+        return error
+
+    resp = jsonify(job_id=job_id, status="queued")
+    resp.status_code = 202
+
+    # mark browser as used for guests
+    if not session.get('user_id'):
+        resp.set_cookie('guest_used', '1', max_age=60*60*24)
+    return resp
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+@nocache
+def job_status(job_id):
+    job = get_own_job(job_id)
+    if not job:
+        return jsonify(error="Job not found."), 404
+    return jsonify(settle_job(job))
+
+
+@app.route("/results/<name>", methods=["GET"])
+def guest_result(name):
+    """A guest's generated image, for as long as the temp store keeps it"""
+    path = guest_results.path(name)
+    if not path:
+        abort(404)
+    resp = send_file(path, mimetype="image/png", max_age=guest_results.ttl)
+    resp.headers['Cache-Control'] = f'private, max-age={guest_results.ttl}'
+    return resp
+
+
+@app.route(f"{IMAGES_URL}/<path:name>", methods=["GET"])
+def generated_image(name):
+    """A stored image or thumbnail, with validators; cached for good if its name is its hash"""
+    path = safe_join(GENERATED_FOLDER, name)
+    if not path or any(part.startswith('.') for part in name.split('/')) or not os.path.isfile(path):
+        abort(404)
+
+    stat = os.stat(path)
+    last_modified = stat.st_mtime
+    if image_store.content_addressed(f"generated/{name}"):
+        # The name is the content's hash, so it is a strong validator itself
+        etag = os.path.basename(name)
+        cache_control = f'public, max-age={IMAGE_MAX_AGE}, immutable'
+    else:
+        etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+        cache_control = f'public, max-age={LEGACY_IMAGE_MAX_AGE}, must-revalidate'
+    if IMAGE_ACCEL_REDIRECT:
+        resp = Response(mimetype=mimetypes.guess_type(path)[0])
+        resp.headers['X-Accel-Redirect'] = f"{IMAGE_ACCEL_REDIRECT.rstrip('/')}/{name}"
+        resp.set_etag(etag)
+        resp.last_modified = last_modified
+    else:
+        # Answers If-None-Match / If-Modified-Since with 304 and Range with 206
+        resp = send_file(path, conditional=True, etag=etag, last_modified=last_modified)
+    resp.headers['Cache-Control'] = cache_control
+    return resp
+
+
+@app.route("/img/<int:generation_id>", methods=["GET"])
+def resized_image(generation_id):
+    """One of the user's library images at another size: /img/<id>?w=800&fmt=webp"""
+    if 'user_id' not in session:
+        abort(401)
+    width = request.args.get('w', type=int)
+    fmt = request.args.get('fmt', 'webp').lower()
+    if not width or fmt not in RESIZE_FORMATS:
+        abort(400)
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT image_path FROM generations WHERE id = ? AND user_id = ?",
+                   (generation_id, session['user_id']))
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        abort(404)
+
+    src = image_store.full_path(row[0])
+    if not os.path.exists(src):
+        abort(404)
+    try:
+        try:
+            resp = send_file(resizer.get(src, width, fmt), mimetype=RESIZE_FORMATS[fmt], max_age=86400)
+        except FileNotFoundError:
+            # Evicted (maybe by another worker) between the lookup and the read
+            resp = send_file(resizer.render(src, width, fmt), mimetype=RESIZE_FORMATS[fmt], max_age=86400)
+    except Exception as e:
+        print(f"Error resizing image {generation_id}: {e}")
+        abort(500)
+    resp.headers['Cache-Control'] = 'private, max-age=86400'
+    return resp
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job_route(job_id):
+    job = get_own_job(job_id)
+    if not job:
+        return jsonify(error="Job not found."), 404
+    cancel_generation(job_id)
+    return jsonify(settle_job(get_job(job_id)))
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """Server-Sent Events stream of a job's status and diffusion progress.
+
+    Ends with a `finished` event; the client then fetches GET /jobs/<id>
+    for the result, which is also where failed jobs are refunded. If the
+    client goes away before that, the job is cancelled.
+    """
+    if not get_own_job(job_id):
+        return jsonify(error="Job not found."), 404
+
+    def sse(event, data):
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    def stream():
+        last_status = last_step = last_preview = None
+        deadline = time.time() + GENERATION_TIMEOUT + 60
+        try:
+            while time.time() < deadline:
+                job = get_job(job_id)
+                if job['status'] != last_status:
+                    last_status = job['status']
+                    yield sse("status", {"status": job['status']})
+                if job['status'] in FINISHED_STATES:
+                    yield sse("finished", {"status": job['status']})
+                    return
+
+                # Followers show the progress of the job doing the work
+                source = get_job(job['leader_id']) if job['status'] == ATTACHED else job
+                if source and source['progress_step'] and source['progress_step'] != last_step:
+                    last_step = source['progress_step']
+                    data = {"step": source['progress_step'], "total": source['progress_total']}
+                    if source['preview'] and source['preview'] != last_preview:
+                        last_preview = source['preview']
+                        data["previews"] = json.loads(source['preview'])
+                    yield sse("progress", data)
+                else:
+                    # Comment line; writing it is how a closed tab gets noticed
+                    yield ": keepalive\n\n"
+                time.sleep(0.5)
+        except GeneratorExit:
+            cancel_generation(job_id)
+            raise
+
+    return Response(stream_with_context(stream()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+### Operations ###
+# Hit rates of this process's caches and the state of the inference
+# endpoints, for monitoring. Only answered with the STATS_TOKEN bearer token.
+STATS_TOKEN = os.environ.get('STATS_TOKEN')
+
+
+@app.route("/internal/stats", methods=["GET"])
+def internal_stats():
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not STATS_TOKEN or not hmac.compare_digest(supplied.encode(), STATS_TOKEN.encode()):
+        abort(404)
+    return jsonify(
+        pid=os.getpid(),
+        account_cache=account_cache.stats(),
+        result_cache=result_cache.stats(),
+        resizer=resizer.stats(),
+        backends=router.stats(),
+    )
+
+
 ### Home Page ###
 @app.route("/home", methods=["GET", "POST"])
 @nocache
@@ -479,90 +937,21 @@ def home():
         return redirect(url_for('login'))
 
     user_id = session['user_id']
-    user = get_user_by_id(user_id)
-    active_sub = get_active_subscription(user_id)
 
     if request.method == "POST":
-        # --- Credit Check ---
-        if not deduct_credit(user_id):
-            return jsonify(error="You don't have enough credits to generate images."), 403
+        job_id, error = submit_generation(request.form["prompt"], request.form["aspect"])
+        if error:
+            return error
 
-        global is_generating
-        if is_generating:
-            return jsonify(error="Generation already in progress"), 429
+        payload = settle_job(wait_for_job(job_id))
+        if payload['status'] == FAILED:
+            return jsonify(error=payload['error']), 500
+        if payload['status'] == CANCELLED:
+            return jsonify(error="Generation is taking longer than expected.", job_id=job_id), 504
 
-        is_generating = True
-        prompt = request.form["prompt"]
-        aspect = request.form["aspect"]
-        headers = {"ngrok-skip-browser-warning": "true"}
-        images = []
-
-        try:
-            r = requests.post(COLAB_API, json={
-                "prompt": prompt,
-                "negative_prompt": "blury",
-                "guidance_scale": 7.5,
-                "aspect": aspect
-            }, headers=headers, timeout=120)
-            r.raise_for_status()
-            data = r.json()
-            base64_strings = data.get("images", [])
-            images = ["data:image/png;base64," + s for s in base64_strings]
-
-            # Save to DB
-            if base64_strings:
-                import base64, os
-                from datetime import datetime
-
-                folder = os.path.join("static", "generated")
-                os.makedirs(folder, exist_ok=True)
-
-                for i, base64_str in enumerate(base64_strings):
-                    image_data = base64.b64decode(base64_str)
-                    filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{i}.png"
-                    filepath = os.path.join(folder, filename)
-                    with open(filepath, "wb") as f:
-                        f.write(image_data)
-
-                    conn = get_connection()
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        INSERT INTO generations (user_id, prompt, image_path, aspect_ratio)
-                        VALUES (?, ?, ?, ?)
-                    """, (user_id, prompt, f"generated/{filename}", aspect))
-                    conn.commit()
-                    conn.close()
-
-        except Exception as e:
-            print(f"Error generating images: {e}")
-            # Rollback credit deduction on failure
-            conn = get_connection()
-            cursor = conn.cursor()
-            
-            # Try to restore subscription credit first
-            if active_sub:
-                cursor.execute("""
-                    UPDATE subscriptions 
-                    SET credits_remaining = credits_remaining + 1 
-                    WHERE id = ?
-                """, (active_sub['id'],))
-            
-            # Otherwise restore user credit
-            else:
-                cursor.execute("""
-                    UPDATE users 
-                    SET credits = credits + 1 
-                    WHERE id = ?
-                """, (user_id,))
-            
-            conn.commit()
-            conn.close()
-            return jsonify(error="An error occurred while generating images."), 500
-        finally:
-            is_generating = False
-
-        return jsonify(images=images)
+        return jsonify(images=payload.get("images", []))
 
+    user, active_sub = get_account(user_id)
     return render_template("home_page.html", user=user, active_sub=active_sub)
 
 
@@ -574,8 +963,93 @@ def library():
         flash("Please log in to access this page", "warning")
         return redirect(url_for('login'))
 
-    images = get_generations_by_user_id(session['user_id'])
-    return render_template("library.html", images=images)
+    rows = get_generations_by_user_id(session['user_id'], limit=LIBRARY_PAGE_SIZE + 1)
+    images, next_cursor = library_page(rows, LIBRARY_PAGE_SIZE)
+    return render_template("library.html", images=images, next_cursor=next_cursor)
+
+
+@app.route('/api/library', methods=['GET'])
+def library_api():
+    """Further library pages for infinite scroll: ?cursor=<next_cursor>&limit=N
+
+    With ?q=<text> the pages hold the generations whose prompt matches it,
+    best match first; their cursors only continue the same search.
+    """
+    if 'user_id' not in session:
+        return jsonify(success=False, message='Not logged in'), 401
+
+    limit = min(max(request.args.get('limit', LIBRARY_PAGE_SIZE, type=int), 1), 100)
+    query = request.args.get('q', '').strip()
+    keys = SEARCH_CURSOR if query else LIBRARY_CURSOR
+    after = None
+    if request.args.get('cursor'):
+        after = decode_cursor(request.args['cursor'], keys)
+        if not after:
+            return jsonify(success=False, message='Invalid cursor'), 400
+
+    if query:
+        rows = search_generations_by_user_id(session['user_id'], query, limit + 1, after=after)
+    else:
+        rows = get_generations_by_user_id(session['user_id'], limit=limit + 1, before=after)
+    images, next_cursor = library_page(rows, limit, keys)
+    return jsonify(
+        images=[{field: image[field] for field in LIBRARY_FIELDS} for image in images],
+        next_cursor=next_cursor
+    )
+
+
+LIBRARY_PAGE_SIZE = 24
+LIBRARY_FIELDS = ('id', 'prompt', 'aspect_ratio', 'created_at', 'url', 'width', 'height',
+                  'placeholder', 'srcsets', 'card_type')
+# Columns a page's cursor is made of, with their types: newest first for
+# the whole library, best match first for a search
+LIBRARY_CURSOR = (('created_at', str), ('id', int))
+SEARCH_CURSOR = (('rank', (int, float)), ('id', int))
+
+
+def encode_cursor(row, keys=LIBRARY_CURSOR):
+    return base64.urlsafe_b64encode(json.dumps([row[key] for key, _ in keys]).encode()).decode()
+
+
+def decode_cursor(cursor, keys=LIBRARY_CURSOR):
+    """The values encode_cursor() took from the row, or None if it isn't such a cursor"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != len(keys):
+        return None
+    if not all(isinstance(value, kind) and not isinstance(value, bool)
+               for value, (_, kind) in zip(values, keys)):
+        return None
+    return tuple(values)
+
+
+def library_page(rows, limit, keys=LIBRARY_CURSOR):
+    """Library cards for up to `limit` rows, and the cursor of the next page if there is one"""
+    images = [library_image(row) for row in rows[:limit]]
+    next_cursor = encode_cursor(rows[limit - 1], keys) if len(rows) > limit else None
+    return images, next_cursor
+
+
+def library_image(row):
+    """A library row plus what the grid needs to lay it out and pick a thumbnail"""
+    image = dict(row)
+    image['url'] = image_url(image['image_path'])
+    width, height = image.get('width'), image.get('height')
+    if width and height:
+        image['card_type'] = 'portrait' if height > width else 'square'
+    else:
+        image['card_type'] = 'portrait' if image['aspect_ratio'] == 'portrait' else 'square'
+
+    # {"avif": "...256.avif 256w, ...512.avif 512w", "webp": ...}; empty for
+    # images stored before thumbnails existed, which load the original
+    srcsets = {}
+    for variant in json.loads(image.get('variants') or '[]'):
+        url = image_url(variant['path'])
+        srcsets.setdefault(variant['format'], []).append(f"{url} {variant['width']}w")
+    image['srcsets'] = {fmt: ", ".join(entries) for fmt, entries in srcsets.items()}
+    return image
 
 
 # ── Account management API ------------------------------------
@@ -592,6 +1066,7 @@ def change_username():
     try:
         cur.execute('UPDATE users SET username = ? WHERE id = ?', (new, session['user_id']))
         conn.commit()
+        forget_account(session['user_id'])
         session['username'] = new
         session['initials'] = get_initials(new)
         return jsonify(success=True)
@@ -611,22 +1086,22 @@ def delete_account():
     conn = get_connection()
     cur = conn.cursor()
 
-    # 1. Remove generated images (files + DB records)
+    # 1. Remove generated images (DB records, and files nobody else uses)
+    cur.execute('BEGIN IMMEDIATE')
     cur.execute('SELECT image_path FROM generations WHERE user_id = ?', (user_id,))
-    rows = cur.fetchall()
-    for row in rows:
-        try:
-            os.remove(os.path.join('static', row[0]))
-        except FileNotFoundError:
-            pass
+    unused = []
+    for row in cur.fetchall():
+        unused.extend(image_store.release(cur, row[0]))
     cur.execute('DELETE FROM generations WHERE user_id = ?', (user_id,))
     cur.execute('DELETE FROM credit_transactions WHERE user_id = ?', (user_id,))
     cur.execute('DELETE FROM subscriptions WHERE user_id = ?', (user_id,))
     cur.execute('DELETE FROM transactions WHERE user_id = ?', (user_id,))
     cur.execute('DELETE FROM oauth_users WHERE user_id = ?', (user_id,))
     cur.execute('DELETE FROM users WHERE id = ?', (user_id,))
+    image_store.unlink(unused)
     conn.commit()
     conn.close()
+    forget_account(user_id)
 
     session.clear()
     return jsonify(success=True)
@@ -653,17 +1128,16 @@ def delete_image(image_id):
     conn = get_connection()
     cursor = conn.cursor()
 
+    cursor.execute('BEGIN IMMEDIATE')
     cursor.execute("SELECT image_path FROM generations WHERE id = ? AND user_id = ?", (image_id, session['user_id']))
     image = cursor.fetchone()
 
     if image:
         try:
-            import os
-            image_path = os.path.join("static", image[0])
-            if os.path.exists(image_path):
-                os.remove(image_path)
-
+            # The file goes only when no other generation or cache entry uses it
+            unused = image_store.release(cursor, image[0])
             cursor.execute("DELETE FROM generations WHERE id = ?", (image_id,))
+            image_store.unlink(unused)
             conn.commit()
             return jsonify(success=True)
         except Exception as e:
@@ -693,8 +1167,7 @@ def initiate_payment(plan):
     plan_data = plans[plan]
     
     # Check if user has less than 5 credits before allowing purchase
-    user = get_user_by_id(user_id)
-    active_sub = get_active_subscription(user_id)
+    user, active_sub = get_account(user_id)
     
     total_credits = 0
     if user and user['credits']:
@@ -831,8 +1304,11 @@ def esewa_success():
             end_date,
             transaction_id
         ))
+        record_credit(cursor, user_id, PURCHASE, credits, SUBSCRIPTION,
+                      subscription_id=cursor.lastrowid, reference=str(transaction_id))
         
         conn.commit()
+        forget_account(user_id)
         
         # Clear payment session
         session.pop('payment_info', None)
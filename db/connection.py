@@ -0,0 +1,109 @@
+import queue
+import sqlite3
+
+# Applied to every new connection. WAL lets readers run alongside the one
+# writer; NORMAL sync is still safe in WAL mode (a power cut can only lose
+# the last commits, never corrupt the file).
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA mmap_size=268435456",   # 256 MB
+    "PRAGMA cache_size=-16000",     # 16 MB
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+class PooledConnection:
+    """A pooled sqlite3 connection, checked out by `ConnectionManager.get()`.
+
+    Behaves like the connection it wraps, except that `close()` rolls back
+    whatever wasn't committed and hands it back to the pool. It can't be
+    used after that.
+    """
+
+    _conn = None
+
+    def __init__(self, manager, conn):
+        object.__setattr__(self, '_manager', manager)
+        object.__setattr__(self, '_conn', conn)
+
+    def __getattr__(self, name):
+        conn = self._conn
+        if conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(conn, name)
+
+    def __setattr__(self, name, value):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def close(self):
+        conn = self._conn
+        if conn is None:
+            return
+        object.__setattr__(self, '_conn', None)
+        self._manager._release(conn)
+
+    def __del__(self):
+        # Some code paths never close; don't let them drain the pool
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionManager:
+    """Hands out reusable connections to one SQLite database.
+
+    `get()` takes an idle connection from the pool, or opens a new one with
+    `PRAGMAS` applied, and its `close()` puts it back; up to `max_idle` are
+    kept. Each checkout belongs to one caller at a time, so nested helpers
+    (and their transactions) never share a connection, but the sqlite3
+    objects themselves move freely between threads. Every checkout starts
+    with `row_factory` set to the manager's default. With `uri=True`,
+    `path` is an SQLite URI such as 'file:copy.db?immutable=1'.
+    """
+
+    def __init__(self, path, max_idle=8, row_factory=None, uri=False):
+        self.path = path
+        self.row_factory = row_factory
+        self.uri = uri
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, uri=self.uri)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def get(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        conn.row_factory = self.row_factory
+        return PooledConnection(self, conn)
+
+    def _release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
@@ -0,0 +1,126 @@
+from db.database import get_connection
+
+# Where a credit comes from: the user's active subscription first, then the
+# account balance in users.credits
+SUBSCRIPTION = 'subscription'
+ACCOUNT = 'account'
+
+# credit_transactions.kind
+RESERVE = 'reserve'     # taken when a generation is queued
+COMMIT = 'commit'       # the generation was delivered; the credit stays spent
+RELEASE = 'release'     # the generation failed or was cancelled; the credit is back
+PURCHASE = 'purchase'   # a paid plan's credits
+
+
+def record(cursor, user_id, kind, delta, source, subscription_id=None, reference=None):
+    """Append one movement to the credit ledger."""
+    cursor.execute("""
+        INSERT INTO credit_transactions
+        (user_id, kind, delta, source, subscription_id, reference)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (user_id, kind, delta, source, subscription_id, reference))
+
+
+def _open_reservation(cursor, reference):
+    """The reserve row for `reference` if it was neither committed nor released."""
+    cursor.execute("""
+        SELECT user_id, source, subscription_id FROM credit_transactions r
+        WHERE r.reference = ? AND r.kind = 'reserve'
+        AND NOT EXISTS (
+            SELECT 1 FROM credit_transactions f
+            WHERE f.reference = r.reference AND f.kind IN ('commit', 'release')
+        )
+    """, (reference,))
+    return cursor.fetchone()
+
+
+def reserve_credit(user_id, reference):
+    """Take one credit from `user_id` for the work identified by `reference`.
+
+    The subscription is charged if it has credits left, otherwise the
+    account balance. Returns the id of the subscription charged (None for
+    the balance), or False if the user has no credits. Finish the
+    reservation with `commit_credit()` or `release_credit()`.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        # The write lock is held from here on, so the balances can't change
+        # between reading and charging them
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute("""
+            SELECT id FROM subscriptions
+            WHERE user_id = ?
+            AND status = 'active'
+            AND end_date > datetime('now')
+            AND credits_remaining > 0
+            ORDER BY end_date DESC
+            LIMIT 1
+        """, (user_id,))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute("""
+                UPDATE subscriptions SET credits_remaining = credits_remaining - 1
+                WHERE id = ?
+            """, (row[0],))
+            source, subscription_id = SUBSCRIPTION, row[0]
+        else:
+            cursor.execute("""
+                UPDATE users SET credits = credits - 1
+                WHERE id = ? AND credits > 0
+            """, (user_id,))
+            if cursor.rowcount != 1:
+                conn.rollback()
+                return False
+            source, subscription_id = ACCOUNT, None
+
+        record(cursor, user_id, RESERVE, -1, source, subscription_id, reference)
+        conn.commit()
+        return subscription_id
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def commit_credit(cursor, reference):
+    """Mark the reservation for `reference` as spent, inside the caller's transaction."""
+    reservation = _open_reservation(cursor, reference)
+    if not reservation:
+        return False
+    user_id, source, subscription_id = reservation
+    record(cursor, user_id, COMMIT, 0, source, subscription_id, reference)
+    return True
+
+
+def release_credit(reference):
+    """Give back the credit reserved for `reference`.
+
+    Returns False if there was nothing to give back: no reservation, or it
+    was already committed or released.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        reservation = _open_reservation(cursor, reference)
+        if not reservation:
+            conn.rollback()
+            return False
+        user_id, source, subscription_id = reservation
+        if source == SUBSCRIPTION:
+            cursor.execute("""
+                UPDATE subscriptions SET credits_remaining = credits_remaining + 1
+                WHERE id = ?
+            """, (subscription_id,))
+        else:
+            cursor.execute("UPDATE users SET credits = credits + 1 WHERE id = ?", (user_id,))
+        record(cursor, user_id, RELEASE, 1, source, subscription_id, reference)
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
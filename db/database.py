@@ -1,138 +1,25 @@
+import re
 import sqlite3
 from pathlib import Path
 
+from db.connection import ConnectionManager
+from db.migrations import migrate
+from db.search import search_available, search_prompts
+
 DB_PATH = "db/dataset.db"  
+# Connections are pooled (WAL mode, tuned pragmas); close() returns them
+connections = ConnectionManager(DB_PATH)
+
 def get_connection():
-    return sqlite3.connect(DB_PATH)
+    return connections.get()
 
 def init_db():
+    """Bring the database schema up to date (see db/migrations.py)."""
     conn = get_connection()
-    cursor = conn.cursor()
-
-   
-    # Create tables
-    #Stores basic user info.
-    cursor.execute('''
-                    
-            CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT NOT NULL,
-        email TEXT UNIQUE,
-        password TEXT NOT NULL,
-        credits INTEGER DEFAULT 3,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        verified BOOLEAN NOT NULL DEFAULT 0
-    );''')
-
-    cursor.execute('''
-            CREATE TABLE IF NOT EXISTS verification_codes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT NOT NULL,
-                code TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                expires_at TIMESTAMP
-            )
-        ''')
-
-    
-# Stores user-generated images and prompts.
-    cursor.execute('''
-       CREATE TABLE IF NOT EXISTS generations (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    prompt TEXT,
-    image_path TEXT,
-    aspect_ratio TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users(id)
-);
-
-    ''')
-    
-# Logs credit usage or top-up history
-  
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            plan_name TEXT NOT NULL,
-            amount REAL NOT NULL,
-            status TEXT NOT NULL,
-            pid TEXT NOT NULL,
-            ref_id TEXT,
-            payment_method TEXT DEFAULT 'eSewa',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            plan_name TEXT NOT NULL,
-            credits_remaining INTEGER NOT NULL,
-            max_credits INTEGER NOT NULL,
-            start_date DATETIME NOT NULL,
-            end_date DATETIME NOT NULL,
-            status TEXT DEFAULT 'active',
-            transaction_id INTEGER,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (transaction_id) REFERENCES transactions(id)
-        )
-    ''')
-# If you're using email/OTP/Google OAuth
-    cursor.execute('''
-       CREATE TABLE IF NOT EXISTS pending_verifications (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    email TEXT NOT NULL,
-    otp TEXT,
-    expires_at TIMESTAMP,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
-
-
-    ''')
-    
-# Stores OAuth user data for third-party logins (e.g., Google)    
-    cursor.execute('''
-      CREATE TABLE IF NOT EXISTS oauth_users (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    provider TEXT NOT NULL,        -- e.g., "google"
-    provider_user_id TEXT UNIQUE,  -- e.g., Google sub ID
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users(id)
-);
-
-
-    ''')
-    
-    # Stores admin user data for admin panel
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS admins (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    ''')
-
-    # Stores subscription plans
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS plans (
-            id TEXT PRIMARY KEY, -- e.g., 'basic', 'pro'
-            name TEXT NOT NULL,
-            credits INTEGER NOT NULL,
-            amount REAL NOT NULL,
-            active BOOLEAN NOT NULL DEFAULT 1
-        );
-    ''')
-
-
-    conn.commit()
-    conn.close()
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
     
     
 ## function to get user data through user_id ### used in home page
@@ -145,11 +32,61 @@ def get_user_by_id(user_id):
     conn.close()
     return user
 ## function to get image promts, aspect ratio and image path through user_id ### used in library page
-def get_generations_by_user_id(user_id):
+def get_generations_by_user_id(user_id, limit=-1, before=None):
+    """A user's generations, newest first.
+
+    Pages through them by keyset: pass the (created_at, id) of the last row
+    of the previous page as `before` to get the `limit` rows that follow it.
+    """
     conn = get_connection()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM generations WHERE user_id = ?', (user_id,))
+    keyset = 'AND (g.created_at, g.id) < (?, ?)' if before else ''
+    cursor.execute(f'''
+        SELECT g.*, b.placeholder, b.variants
+        FROM generations g
+        LEFT JOIN image_blobs b ON b.path = g.image_path
+        WHERE g.user_id = ? {keyset}
+        ORDER BY g.created_at DESC, g.id DESC
+        LIMIT ?
+    ''', (user_id, *(before or ()), limit))
+    generations = cursor.fetchall()
+    conn.close()
+    return generations
+
+def search_generations_by_user_id(user_id, text, limit, after=None):
+    """A user's generations whose prompt matches `text`, best match first.
+
+    Rows are as from get_generations_by_user_id() plus a `rank`. Page with
+    `after`, the (rank, id) of the last row of the previous page. Without
+    FTS5 every word of `text` has to appear in the prompt instead, and
+    matches come newest first.
+    """
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    if search_available(cursor):
+        generations = search_prompts(cursor, text, limit, after, user_id=user_id)
+        conn.close()
+        return generations
+
+    words = re.findall(r'\w+', text)
+    if not words:
+        conn.close()
+        return []
+    conditions = ["g.prompt LIKE ? ESCAPE '\\'"] * len(words)
+    params = ['%' + re.sub(r'([\\%_])', r'\\\1', word) + '%' for word in words]
+    if after:
+        conditions.append("g.id < ?")
+        params.append(after[1])
+    cursor.execute(f'''
+        SELECT g.*, b.placeholder, b.variants, 0.0 AS rank
+        FROM generations g
+        LEFT JOIN image_blobs b ON b.path = g.image_path
+        WHERE g.user_id = ? AND {' AND '.join(conditions)}
+        ORDER BY g.id DESC
+        LIMIT ?
+    ''', (user_id, *params, limit))
     generations = cursor.fetchall()
     conn.close()
     return generations
@@ -0,0 +1,114 @@
+import csv
+import io
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:     # Parquet export is off without it
+    pa = None
+
+# Bulk exports for the admin panel. Rows are read in batches and written out
+# as they come, so an export of any size only holds one batch in memory.
+
+BATCH_SIZE = 5000
+
+# Export name -> (query, [(column, arrow type)]). Queries select the columns
+# in that order and filter on an optional created_at day range.
+EXPORTS = {
+    'transactions': ("""
+        SELECT t.id, t.user_id, u.email, t.plan_name, t.amount, t.status,
+               t.payment_method, t.pid, t.ref_id, t.created_at
+        FROM transactions t
+        LEFT JOIN users u ON t.user_id = u.id
+        WHERE t.created_at >= ? AND t.created_at < date(?, '+1 day')
+        ORDER BY t.created_at, t.id
+    """, [('id', 'int64'), ('user_id', 'int64'), ('email', 'string'),
+          ('plan_name', 'string'), ('amount', 'float64'), ('status', 'string'),
+          ('payment_method', 'string'), ('pid', 'string'), ('ref_id', 'string'),
+          ('created_at', 'string')]),
+    'generations': ("""
+        SELECT g.id, g.user_id, u.email, g.prompt, g.aspect_ratio, g.width,
+               g.height, g.image_path, g.created_at
+        FROM generations g
+        LEFT JOIN users u ON g.user_id = u.id
+        WHERE g.created_at >= ? AND g.created_at < date(?, '+1 day')
+        ORDER BY g.created_at, g.id
+    """, [('id', 'int64'), ('user_id', 'int64'), ('email', 'string'),
+          ('prompt', 'string'), ('aspect_ratio', 'string'), ('width', 'int64'),
+          ('height', 'int64'), ('image_path', 'string'), ('created_at', 'string')]),
+}
+
+FORMATS = {'csv': 'text/csv'}
+if pa is not None:
+    FORMATS['parquet'] = 'application/vnd.apache.parquet'
+
+
+def batches(cursor, name, date_from=None, date_to=None, size=BATCH_SIZE):
+    """Lists of up to `size` rows of export `name`, oldest first.
+
+    `date_from`/`date_to` are inclusive 'YYYY-MM-DD' days; leave them out
+    for everything.
+    """
+    query, _ = EXPORTS[name]
+    cursor.execute(query, (date_from or '0000-01-01', date_to or '9999-12-30'))
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+
+
+def csv_chunks(name, row_batches):
+    """The CSV text of `row_batches`, a header line first, one chunk per batch."""
+    _, columns = EXPORTS[name]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column for column, _ in columns])
+    for rows in row_batches:
+        for row in rows:
+            writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _Chunks(io.RawIOBase):
+    """Write-only file that keeps what was written until it is taken."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def parquet_chunks(name, row_batches):
+    """A Parquet file of `row_batches` in pieces, one row group per batch."""
+    _, columns = EXPORTS[name]
+    schema = pa.schema([(column, getattr(pa, type_)()) for column, type_ in columns])
+    sink = _Chunks()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    try:
+        for rows in row_batches:
+            arrays = [pa.array(values, type=field.type)
+                      for values, field in zip(zip(*rows), schema)]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
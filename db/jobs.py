@@ -0,0 +1,371 @@
+import json
+import sqlite3
+import uuid
+
+from db.credits import commit_credit
+from db.database import get_connection
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+ATTACHED = 'attached'   # waiting on an identical leader job instead of the GPU
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def create_job(prompt, aspect, negative_prompt=None, guidance_scale=None, steps=None,
+               seed=None, user_id=None, guest_token=None, subscription_id=None,
+               request_key=None, deadline=None, job_id=None, lease_seconds=None):
+    """Queue a generation request and return its public job id.
+
+    `deadline` is the unix time after which nobody waits for the result any
+    more; it is passed on to the inference server so it can drop the work.
+
+    If `request_key` matches a job that is still queued or running, the new
+    job is attached to it as a follower and will receive a copy of its
+    images instead of running inference again.
+
+    Pass `job_id` (from `new_job_id()`) when something, like a credit
+    reservation, has to refer to the job before it exists.
+
+    With `lease_seconds` the job starts out running, outside the queue, for
+    work the caller does itself (e.g. serving a cached result). Should the
+    process die first, the lease runs out and `claim_job` queues it.
+    """
+    job_id = job_id or new_job_id()
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        leader = None
+        if request_key and not lease_seconds:
+            cursor.execute("""
+                SELECT id FROM generation_jobs
+                WHERE request_key = ? AND status IN ('queued', 'running')
+                ORDER BY rowid
+                LIMIT 1
+            """, (request_key,))
+            leader = cursor.fetchone()
+
+        cursor.execute("""
+            INSERT INTO generation_jobs
+            (id, user_id, guest_token, subscription_id, prompt,
+             negative_prompt, guidance_scale, aspect, steps, seed,
+             request_key, leader_id, deadline, status, lease_expires_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                    CASE WHEN ? IS NULL THEN NULL ELSE datetime('now', ?) END)
+        """, (job_id, user_id, guest_token, subscription_id, prompt,
+              negative_prompt, guidance_scale, aspect, steps, seed,
+              request_key, leader[0] if leader else None, deadline,
+              RUNNING if lease_seconds else ATTACHED if leader else QUEUED,
+              lease_seconds, f'+{int(lease_seconds or 0)} seconds'))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return job_id
+
+
+def get_followers(leader_id):
+    """Jobs still waiting on the result of `leader_id`."""
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT * FROM generation_jobs
+            WHERE leader_id = ? AND status = 'attached'
+            ORDER BY rowid
+        """, (leader_id,))
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
+
+def take_followers(leader_id):
+    """Close `leader_id` to new followers and claim the ones it has.
+
+    In one transaction the leader's request_key is cleared, so identical
+    requests from now on start a job of their own, and its attached
+    followers move to 'running' under the leader's lease, so `claim_job`
+    leaves them alone while they are delivered. Returns their rows.
+    """
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute("UPDATE generation_jobs SET request_key = NULL WHERE id = ?", (leader_id,))
+        cursor.execute("""
+            SELECT * FROM generation_jobs
+            WHERE leader_id = ? AND status = 'attached'
+            ORDER BY rowid
+        """, (leader_id,))
+        followers = cursor.fetchall()
+        cursor.execute("""
+            UPDATE generation_jobs
+            SET status = 'running',
+                started_at = datetime('now'),
+                lease_expires_at = (SELECT lease_expires_at FROM generation_jobs WHERE id = ?)
+            WHERE leader_id = ? AND status = 'attached'
+        """, (leader_id, leader_id))
+        conn.commit()
+        return followers
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def get_job(job_id):
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT * FROM generation_jobs WHERE id = ?', (job_id,))
+        return cursor.fetchone()
+    finally:
+        conn.close()
+
+
+def claim_job(backend, concurrency, lease_seconds, max_attempts=3):
+    """Atomically move the oldest queued job to 'running' on `backend`.
+
+    The running count is checked inside the same write transaction, so the
+    per-backend concurrency limit holds across every worker process sharing
+    the database. Returns the claimed row, or None if there is nothing to do
+    or the backend is already at capacity.
+    """
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+
+        # Recover jobs whose worker died without reporting back
+        cursor.execute("""
+            UPDATE generation_jobs
+            SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+                error = CASE WHEN attempts >= ? THEN 'Worker lease expired' ELSE error END,
+                finished_at = CASE WHEN attempts >= ? THEN datetime('now') ELSE finished_at END,
+                backend = NULL,
+                lease_expires_at = NULL
+            WHERE status = 'running' AND lease_expires_at < datetime('now')
+        """, (max_attempts, max_attempts, max_attempts))
+        # A cancelled leader keeps its lease while its worker is still
+        # producing images for the followers
+        cursor.execute("""
+            UPDATE generation_jobs
+            SET status = 'failed', error = 'Leader job failed', finished_at = datetime('now')
+            WHERE status = 'attached'
+            AND leader_id IN (
+                SELECT id FROM generation_jobs
+                WHERE status = 'failed'
+                OR (status = 'cancelled' AND lease_expires_at < datetime('now'))
+            )
+        """)
+        # Followers still attached to a finished leader missed its delivery
+        # (it is normally taken over by take_followers); run them on their own
+        cursor.execute("""
+            UPDATE generation_jobs
+            SET status = 'queued', leader_id = NULL
+            WHERE status = 'attached'
+            AND leader_id IN (SELECT id FROM generation_jobs WHERE status = 'done')
+        """)
+
+        cursor.execute("""
+            SELECT COUNT(*) FROM generation_jobs
+            WHERE status = 'running' AND backend = ?
+        """, (backend,))
+        if cursor.fetchone()[0] >= concurrency:
+            conn.commit()
+            return None
+
+        cursor.execute("""
+            SELECT id FROM generation_jobs
+            WHERE status = 'queued'
+            ORDER BY rowid
+            LIMIT 1
+        """)
+        row = cursor.fetchone()
+        if not row:
+            conn.commit()
+            return None
+
+        cursor.execute("""
+            UPDATE generation_jobs
+            SET status = 'running',
+                backend = ?,
+                attempts = attempts + 1,
+                started_at = datetime('now'),
+                lease_expires_at = datetime('now', ?)
+            WHERE id = ?
+        """, (backend, f'+{int(lease_seconds)} seconds', row['id']))
+        cursor.execute('SELECT * FROM generation_jobs WHERE id = ?', (row['id'],))
+        job = cursor.fetchone()
+        conn.commit()
+        return job
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def cancel_job(job_id):
+    """Mark an unfinished job cancelled and return its row from just before.
+
+    Returns None if the job had already finished. Followers of a queued
+    leader are handed over to the oldest of them, which takes the leader's
+    place in the queue. A running leader is only flagged: its worker still
+    delivers to any followers, and the caller decides whether to stop the
+    inference itself.
+    """
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT * FROM generation_jobs WHERE id = ?', (job_id,))
+        job = cursor.fetchone()
+        if not job or job['status'] in FINISHED_STATES:
+            conn.commit()
+            return None
+
+        cursor.execute("""
+            UPDATE generation_jobs
+            SET status = 'cancelled', error = 'Cancelled', finished_at = datetime('now')
+            WHERE id = ?
+        """, (job_id,))
+
+        if job['status'] == QUEUED:
+            cursor.execute("""
+                SELECT id FROM generation_jobs
+                WHERE leader_id = ? AND status = 'attached'
+                ORDER BY rowid
+                LIMIT 1
+            """, (job_id,))
+            heir = cursor.fetchone()
+            if heir:
+                cursor.execute("""
+                    UPDATE generation_jobs SET status = 'queued', leader_id = NULL
+                    WHERE id = ?
+                """, (heir['id'],))
+                cursor.execute("""
+                    UPDATE generation_jobs SET leader_id = ?
+                    WHERE leader_id = ? AND status = 'attached'
+                """, (heir['id'], job_id))
+        conn.commit()
+        return job
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def update_progress(job_id, step, total, previews=None):
+    """Record the latest diffusion step (and latent previews, if any) of a job."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        if previews:
+            cursor.execute("""
+                UPDATE generation_jobs
+                SET progress_step = ?, progress_total = ?, preview = ?
+                WHERE id = ?
+            """, (step, total, json.dumps(previews), job_id))
+        else:
+            cursor.execute("""
+                UPDATE generation_jobs SET progress_step = ?, progress_total = ?
+                WHERE id = ?
+            """, (step, total, job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def requeue_job(job_id):
+    """Put a running job back in the queue, e.g. after its endpoint went down."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE generation_jobs
+            SET status = 'queued', backend = NULL, lease_expires_at = NULL,
+                progress_step = NULL, progress_total = NULL, preview = NULL
+            WHERE id = ? AND status = 'running'
+        """, (job_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def finish_job(job_id, result):
+    """Store the JSON result of a job and mark it done, settling its credit."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute("""
+            UPDATE generation_jobs
+            SET status = 'done', result = ?, error = NULL,
+                finished_at = datetime('now'), lease_expires_at = NULL
+            WHERE id = ? AND status != 'cancelled'
+        """, (json.dumps(result), job_id))
+        if cursor.rowcount == 1:
+            commit_credit(cursor, job_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def fail_job(job_id, error):
+    """Mark an unfinished job failed. Returns False if it had already finished."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE generation_jobs
+            SET status = 'failed', error = ?,
+                finished_at = datetime('now'), lease_expires_at = NULL
+            WHERE id = ? AND status NOT IN ('done', 'failed', 'cancelled')
+        """, (str(error), job_id))
+        conn.commit()
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+
+def mark_refunded(job_id):
+    """Flag a failed or cancelled job's credit as returned. Returns False if it already was."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            UPDATE generation_jobs SET refunded = 1
+            WHERE id = ? AND refunded = 0
+        """, (job_id,))
+        conn.commit()
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+
+def job_result(job):
+    """Decode the stored result payload of a job row."""
+    if not job or not job['result']:
+        return {}
+    return json.loads(job['result'])
@@ -0,0 +1,410 @@
+# Schema migrations, tracked in PRAGMA user_version.
+#
+# Migration N (counting from 1) runs once, when the database's user_version
+# is below N, and leaves it at N. Add new ones at the end of MIGRATIONS and
+# never edit one that has shipped.
+
+
+def add_column_if_missing(cursor, table, column, definition):
+    """ALTER TABLE ... ADD COLUMN for databases created before the column existed."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def initial_schema(cursor):
+    """Every table up to the first migration.
+
+    Databases that predate user_version get here too, so it only creates
+    what is missing.
+    """
+   
+    # Create tables
+    #Stores basic user info.
+    cursor.execute('''
+                    
+            CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        email TEXT UNIQUE,
+        password TEXT NOT NULL,
+        credits INTEGER DEFAULT 3,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        verified BOOLEAN NOT NULL DEFAULT 0
+    );''')
+
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS verification_codes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email TEXT NOT NULL,
+                code TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP
+            )
+        ''')
+
+    
+# Stores user-generated images and prompts.
+    cursor.execute('''
+       CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    prompt TEXT,
+    image_path TEXT,
+    aspect_ratio TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id)
+);
+
+    ''')
+    
+# Logs credit usage or top-up history
+  
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            plan_name TEXT NOT NULL,
+            amount REAL NOT NULL,
+            status TEXT NOT NULL,
+            pid TEXT NOT NULL,
+            ref_id TEXT,
+            payment_method TEXT DEFAULT 'eSewa',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            plan_name TEXT NOT NULL,
+            credits_remaining INTEGER NOT NULL,
+            max_credits INTEGER NOT NULL,
+            start_date DATETIME NOT NULL,
+            end_date DATETIME NOT NULL,
+            status TEXT DEFAULT 'active',
+            transaction_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (transaction_id) REFERENCES transactions(id)
+        )
+    ''')
+# If you're using email/OTP/Google OAuth
+    cursor.execute('''
+       CREATE TABLE IF NOT EXISTS pending_verifications (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT NOT NULL,
+    otp TEXT,
+    expires_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+
+    ''')
+    
+# Stores OAuth user data for third-party logins (e.g., Google)    
+    cursor.execute('''
+      CREATE TABLE IF NOT EXISTS oauth_users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    provider TEXT NOT NULL,        -- e.g., "google"
+    provider_user_id TEXT UNIQUE,  -- e.g., Google sub ID
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(id)
+);
+
+
+    ''')
+    
+    # Stores admin user data for admin panel
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admins (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+
+    # Stores subscription plans
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS plans (
+            id TEXT PRIMARY KEY, -- e.g., 'basic', 'pro'
+            name TEXT NOT NULL,
+            credits INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            active BOOLEAN NOT NULL DEFAULT 1
+        );
+    ''')
+
+    # Queue of image generation requests drained by the dispatcher workers
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,                -- NULL for guest jobs
+            guest_token TEXT,               -- ties guest jobs to a browser session
+            subscription_id INTEGER,        -- subscription charged at submit time, if any
+            prompt TEXT NOT NULL,
+            negative_prompt TEXT,
+            guidance_scale REAL,
+            aspect TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',  -- queued, running, attached, done, failed, cancelled
+            backend TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            result TEXT,                    -- JSON payload returned to the client
+            error TEXT,
+            refunded BOOLEAN NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            lease_expires_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_generation_jobs_status
+        ON generation_jobs (status, backend)
+    ''')
+    add_column_if_missing(cursor, 'generation_jobs', 'steps', 'INTEGER')
+    add_column_if_missing(cursor, 'generation_jobs', 'seed', 'INTEGER')
+    # Identical in-flight requests share one inference run: followers are
+    # 'attached' to the leader job with the same request_key.
+    add_column_if_missing(cursor, 'generation_jobs', 'request_key', 'TEXT')
+    add_column_if_missing(cursor, 'generation_jobs', 'leader_id', 'TEXT')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_generation_jobs_request_key
+        ON generation_jobs (request_key, status)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_generation_jobs_leader
+        ON generation_jobs (leader_id)
+    ''')
+    # Live progress relayed from the inference server's step callback
+    add_column_if_missing(cursor, 'generation_jobs', 'progress_step', 'INTEGER')
+    add_column_if_missing(cursor, 'generation_jobs', 'progress_total', 'INTEGER')
+    add_column_if_missing(cursor, 'generation_jobs', 'preview', 'TEXT')  # JSON list of data URIs
+    # Unix time after which nobody waits for the job any more
+    add_column_if_missing(cursor, 'generation_jobs', 'deadline', 'REAL')
+
+    # Content-addressed image files and how many rows point at each one
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS image_blobs (
+            hash TEXT PRIMARY KEY,          -- sha256 of the file
+            path TEXT NOT NULL UNIQUE,      -- generated/ab/cd/<hash>.png, relative to static/
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+
+    # Library thumbnails of each file (see services/derivatives.py)
+    add_column_if_missing(cursor, 'image_blobs', 'width', 'INTEGER')
+    add_column_if_missing(cursor, 'image_blobs', 'height', 'INTEGER')
+    add_column_if_missing(cursor, 'image_blobs', 'placeholder', 'TEXT')  # tiny blurred data URI
+    add_column_if_missing(cursor, 'image_blobs', 'variants', 'TEXT')     # JSON [{width, format, path}]
+    # Pixel size of each generation, so pages can lay it out before it loads
+    add_column_if_missing(cursor, 'generations', 'width', 'INTEGER')
+    add_column_if_missing(cursor, 'generations', 'height', 'INTEGER')
+
+    # Finished generations keyed by a hash of every input that affects the pixels
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS result_cache (
+            key TEXT PRIMARY KEY,
+            image_paths TEXT NOT NULL,      -- JSON list of files under static/generated/cache
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at REAL NOT NULL      -- unix time, drives LRU eviction
+        );
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_result_cache_last_used
+        ON result_cache (last_used_at)
+    ''')
+
+    # Library pages: a user's generations, newest first
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_generations_user_created
+        ON generations (user_id, created_at DESC, id DESC)
+    ''')
+
+
+def hot_path_indexes(cursor):
+    # get_active_subscription
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_user_status_end
+        ON subscriptions (user_id, status, end_date)
+    ''')
+    # signup verification: latest code for an email
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_verification_codes_email_created
+        ON verification_codes (email, created_at)
+    ''')
+    # admin dashboard and payments date ranges
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_created
+        ON transactions (created_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_generations_created
+        ON generations (created_at)
+    ''')
+    # Google sign-in lookup
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_oauth_users_provider
+        ON oauth_users (provider, provider_user_id)
+    ''')
+
+
+def credit_ledger(cursor):
+    # Every credit movement (see db/credits.py). A generation's credit is
+    # reserved when it is queued, then committed or released under the same
+    # reference (the job id).
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS credit_transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,             -- reserve, commit, release, purchase
+            delta INTEGER NOT NULL,         -- change to the balance it came from
+            source TEXT NOT NULL,           -- subscription or account
+            subscription_id INTEGER,
+            reference TEXT,                 -- job id, or transaction id for purchases
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_credit_transactions_reference
+        ON credit_transactions (reference, kind)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_credit_transactions_user
+        ON credit_transactions (user_id, created_at)
+    ''')
+
+
+def cache_versions(cursor):
+    # Counters bumped whenever in-memory copies must be reloaded (db/versions.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,          -- e.g. 'plans'
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('plans', 1)")
+
+
+def daily_rollups(cursor):
+    # Per-day totals for the admin dashboard, and how far each source table
+    # has been folded in (db/rollups.py). The first catch-up backfills them.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,           -- YYYY-MM-DD (UTC)
+            generations INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            signups INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_marks (
+            name TEXT PRIMARY KEY,          -- daily_stats column
+            last_id INTEGER NOT NULL        -- highest source row id counted
+        )
+    ''')
+
+
+def prompt_search(cursor):
+    # Full-text index of generation prompts (db/search.py), an external-content
+    # FTS5 table kept in sync by triggers. Builds without FTS5 skip it and
+    # prompt search falls back to LIKE.
+    cursor.execute("PRAGMA compile_options")
+    if 'ENABLE_FTS5' not in [row[0] for row in cursor.fetchall()]:
+        return
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts
+        USING fts5(prompt, content='generations', content_rowid='id', tokenize='unicode61 remove_diacritics 2')
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS generations_fts_insert AFTER INSERT ON generations BEGIN
+            INSERT INTO generations_fts (rowid, prompt) VALUES (new.id, new.prompt);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS generations_fts_delete AFTER DELETE ON generations BEGIN
+            INSERT INTO generations_fts (generations_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS generations_fts_update AFTER UPDATE OF prompt ON generations BEGIN
+            INSERT INTO generations_fts (generations_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+            INSERT INTO generations_fts (rowid, prompt) VALUES (new.id, new.prompt);
+        END
+    ''')
+    # Index what is already there
+    cursor.execute("INSERT INTO generations_fts (generations_fts) VALUES ('rebuild')")
+
+
+def latest_subscriptions(cursor):
+    # users.latest_subscription_id points at the user's newest subscription,
+    # so listings join one row instead of ranking all of them. Triggers keep
+    # it current; new subscriptions are always the newest.
+    add_column_if_missing(cursor, 'users', 'latest_subscription_id', 'INTEGER')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS subscriptions_latest_insert AFTER INSERT ON subscriptions BEGIN
+            UPDATE users SET latest_subscription_id = new.id WHERE id = new.user_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS subscriptions_latest_delete AFTER DELETE ON subscriptions BEGIN
+            UPDATE users SET latest_subscription_id = (
+                SELECT id FROM subscriptions WHERE user_id = old.user_id
+                ORDER BY created_at DESC, id DESC LIMIT 1
+            )
+            WHERE id = old.user_id AND latest_subscription_id = old.id;
+        END
+    ''')
+    cursor.execute('''
+        UPDATE users SET latest_subscription_id = (
+            SELECT id FROM subscriptions WHERE user_id = users.id
+            ORDER BY created_at DESC, id DESC LIMIT 1
+        )
+    ''')
+    # The admin user list pages through users newest first
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_created
+        ON users (created_at DESC, id DESC)
+    ''')
+
+
+MIGRATIONS = [
+    initial_schema,
+    hot_path_indexes,
+    credit_ledger,
+    cache_versions,
+    daily_rollups,
+    prompt_search,
+    latest_subscriptions,
+]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Apply the migrations `conn`'s database hasn't had yet, each in its own transaction."""
+    cursor = conn.cursor()
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if schema_version(conn) >= version:
+            continue
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have got here first
+            if schema_version(conn) < version:
+                migration(cursor)
+                cursor.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
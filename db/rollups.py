@@ -0,0 +1,56 @@
+# Daily totals for the admin dashboard, kept in daily_stats.
+#
+# Each source table is folded in from a high-water mark: catch_up() adds the
+# rows whose id is above the last one counted, grouped by day, and moves the
+# mark. Ids only grow and catch_up() holds the write lock, so no row is
+# counted twice or skipped. Rows deleted later stay counted; these are
+# totals of what happened each day, not of what is left.
+
+# daily_stats column -> the rows and value it sums
+ROLLUPS = {
+    'generations': ("generations", "1", "1"),
+    'revenue': ("transactions", "amount", "amount > 0"),
+    'signups': ("users", "1", "1"),
+}
+
+
+def catch_up(cursor):
+    """Fold rows added since the last call into daily_stats. Call inside BEGIN IMMEDIATE."""
+    for column, (table, value, condition) in ROLLUPS.items():
+        cursor.execute("SELECT last_id FROM rollup_marks WHERE name = ?", (column,))
+        row = cursor.fetchone()
+        last_id = row[0] if row else 0
+        cursor.execute(f"SELECT MAX(id) FROM {table}")
+        max_id = cursor.fetchone()[0]
+        if not max_id or max_id <= last_id:
+            continue
+
+        cursor.execute(f"""
+            INSERT INTO daily_stats (day, {column})
+            SELECT date(created_at), SUM({value}) FROM {table}
+            WHERE id > ? AND id <= ? AND {condition}
+            GROUP BY date(created_at)
+            ON CONFLICT(day) DO UPDATE SET {column} = {column} + excluded.{column}
+        """, (last_id, max_id))
+        cursor.execute("""
+            INSERT INTO rollup_marks (name, last_id) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET last_id = excluded.last_id
+        """, (column, max_id))
+
+
+def totals(cursor, since=None, until=None):
+    """Sums of daily_stats over days in [since, until); both are 'YYYY-MM-DD' or None."""
+    conditions, params = [], []
+    if since:
+        conditions.append("day >= ?")
+        params.append(since)
+    if until:
+        conditions.append("day < ?")
+        params.append(until)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    cursor.execute(f"""
+        SELECT COALESCE(SUM(generations), 0), COALESCE(SUM(revenue), 0), COALESCE(SUM(signups), 0)
+        FROM daily_stats {where}
+    """, params)
+    generations, revenue, signups = cursor.fetchone()
+    return {"generations": generations, "revenue": revenue, "signups": signups}
@@ -0,0 +1,129 @@
+import re
+
+from markupsafe import Markup, escape
+
+# Full-text search over generations.prompt, through the generations_fts index
+# kept in sync by triggers (see db/migrations.py). Works on the caller's
+# cursor, so the app and the admin panel can both use it.
+
+# snippet() wraps matches in these; highlight() turns them into <mark> after
+# escaping the prompt, which is user input
+_OPEN, _CLOSE = '\ue000', '\ue001'
+
+
+def search_available(cursor):
+    """False if the SQLite build had no FTS5 when the index would have been created."""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'generations_fts'")
+    return cursor.fetchone() is not None
+
+
+def match_query(text):
+    """FTS5 query for `text`: every word must match, as a prefix.
+
+    Words are quoted, so FTS5 operators in the input are searched for as
+    plain text. Returns '' if `text` has no words.
+    """
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text))
+
+
+def search_prompts(cursor, text, limit, after=None, user_id=None, date_from=None, date_to=None):
+    """Generations whose prompt matches `text`, best match first.
+
+    Rows have all of the generation's columns plus the user's email, the
+    image's `placeholder` and `variants` (as for the library), a `snippet`
+    of the prompt around the matches (pass it to highlight()) and its
+    `rank`. Equal ranks are newest first. Page with `after`, the (rank, id)
+    of the last row of the previous page. `date_from`/`date_to` are
+    inclusive 'YYYY-MM-DD' days.
+    """
+    query = match_query(text)
+    if not query:
+        return []
+
+    conditions, params = ["generations_fts MATCH ?"], [query]
+    if after:
+        conditions.append("(f.rank > ? OR (f.rank = ? AND g.id < ?))")
+        params.extend([after[0], after[0], after[1]])
+    if user_id is not None:
+        conditions.append("g.user_id = ?")
+        params.append(user_id)
+    if date_from:
+        conditions.append("g.created_at >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("g.created_at < date(?, '+1 day')")
+        params.append(date_to)
+
+    cursor.execute(f"""
+        SELECT g.*, u.email, b.placeholder, b.variants,
+               snippet(generations_fts, 0, '{_OPEN}', '{_CLOSE}', '…', 16) AS snippet,
+               f.rank AS rank
+        FROM generations_fts f
+        JOIN generations g ON g.id = f.rowid
+        LEFT JOIN users u ON u.id = g.user_id
+        LEFT JOIN image_blobs b ON b.path = g.image_path
+        WHERE {' AND '.join(conditions)}
+        ORDER BY f.rank, g.id DESC
+        LIMIT ?
+    """, (*params, limit))
+    return cursor.fetchall()
+
+
+def search_logs(cursor, text, limit, after=None, date_from=None, date_to=None):
+    """Generations whose prompt matches `text` or whose owner's email contains it.
+
+    Prompt matches come first, best first, as in search_prompts(); then
+    the other generations of users with a matching email (case-insensitive
+    substring, like the LIKE search this replaces), newest first. Those
+    have a `rank` of 0 and no snippet. Page with `after`, the (rank, id)
+    of the last row of the previous page.
+    """
+    query = match_query(text)
+    pattern = '%' + re.sub(r'([\\%_])', r'\\\1', text) + '%'
+
+    if query:
+        hits = f"""
+            SELECT rowid AS id, rank,
+                   snippet(generations_fts, 0, '{_OPEN}', '{_CLOSE}', '…', 16) AS snippet
+            FROM generations_fts WHERE generations_fts MATCH ?
+        """
+        hit_params = [query]
+    else:
+        hits = "SELECT NULL AS id, NULL AS rank, NULL AS snippet WHERE 0"
+        hit_params = []
+
+    conditions, params = [], []
+    if after:
+        conditions.append("(m.rank > ? OR (m.rank = ? AND g.id < ?))")
+        params.extend([after[0], after[0], after[1]])
+    if date_from:
+        conditions.append("g.created_at >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("g.created_at < date(?, '+1 day')")
+        params.append(date_to)
+
+    cursor.execute(f"""
+        WITH hits AS ({hits}),
+        matched AS (
+            SELECT id, rank, snippet FROM hits
+            UNION ALL
+            SELECT g.id, 0.0, NULL FROM generations g
+            WHERE g.user_id IN (SELECT id FROM users WHERE email LIKE ? ESCAPE '\\')
+            AND g.id NOT IN (SELECT id FROM hits)
+        )
+        SELECT g.id, g.user_id, u.email, g.prompt, g.aspect_ratio, g.created_at,
+               m.snippet AS snippet, m.rank AS rank
+        FROM matched m
+        JOIN generations g ON g.id = m.id
+        LEFT JOIN users u ON u.id = g.user_id
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY m.rank, g.id DESC
+        LIMIT ?
+    """, (*hit_params, pattern, *params, limit))
+    return cursor.fetchall()
+
+
+def highlight(snippet):
+    """HTML for a snippet from search_prompts(), with the matches in <mark>."""
+    return Markup(str(escape(snippet)).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>'))
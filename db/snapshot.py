@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from urllib.request import pathname2url
+
+from db.connection import ConnectionManager
+
+
+class Snapshot:
+    """Read-only copy of a database, for reports that shouldn't touch the live one.
+
+    `get()` returns a pooled connection to the copy at `path`. Once the copy
+    is more than `max_age` seconds old, the next `get()` starts a new one in
+    a background thread and keeps serving the old one until it is ready;
+    only the very first `get()` waits. `prepare(cursor)`, if given, runs on
+    the source in a write transaction just before each copy.
+
+    Copies are made with the online backup API into a temporary file and
+    renamed over `path`, so several processes can share one. In WAL mode
+    the copy is one read transaction, which doesn't block the app's writers.
+    """
+
+    def __init__(self, source, path, max_age=300, row_factory=None, prepare=None):
+        self.source = source
+        self.path = path
+        self.max_age = max_age
+        self.row_factory = row_factory
+        self.prepare = prepare
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._connections = None
+        self._file = None       # (inode, mtime) of the copy self._connections reads
+
+    def age(self):
+        """Seconds since the current copy was made, or None if there is none."""
+        try:
+            return max(0.0, time.time() - os.path.getmtime(self.path))
+        except OSError:
+            return None
+
+    def get(self):
+        age = self.age()
+        if age is None:
+            self.refresh()
+        elif age > self.max_age:
+            self._refresh_in_background()
+        return self._pool().get()
+
+    def _pool(self):
+        # Connections see the file they were opened on, so a new copy needs a
+        # new pool; ones still checked out finish on the old copy
+        stat = os.stat(self.path)
+        current = (stat.st_ino, stat.st_mtime_ns)
+        with self._lock:
+            if self._file != current:
+                if self._connections:
+                    self._connections.close_all()
+                # immutable: the file never changes once in place, so skip locking
+                uri = f"file:{pathname2url(os.path.abspath(self.path))}?immutable=1"
+                self._connections = ConnectionManager(uri, row_factory=self.row_factory, uri=True)
+                self._file = current
+            return self._connections
+
+    def refresh(self):
+        """Make a new copy now; returns once it is in place."""
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                   prefix='.snapshot-', suffix='.db')
+        os.close(fd)
+        source = sqlite3.connect(self.source, timeout=5)
+        try:
+            if self.prepare:
+                cursor = source.cursor()
+                cursor.execute('BEGIN IMMEDIATE')
+                self.prepare(cursor)
+                source.commit()
+            copy = sqlite3.connect(tmp)
+            try:
+                source.backup(copy)
+                # A single self-contained file, readable without -wal/-shm
+                copy.execute('PRAGMA journal_mode=DELETE')
+            finally:
+                copy.close()
+            os.replace(tmp, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        finally:
+            source.close()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, name='snapshot-refresh', daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"Snapshot refresh error: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
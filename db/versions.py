@@ -0,0 +1,17 @@
+# Version counters for data that processes keep in memory. Writers bump the
+# counter in the same transaction as their change; readers compare it with
+# the version their copy was built from (see services/versioned_cache.py).
+# Only takes cursors, so the admin panel can use it with its own connections.
+
+
+def read_version(cursor, name):
+    cursor.execute("SELECT version FROM cache_versions WHERE name = ?", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def bump_version(cursor, name):
+    cursor.execute("""
+        INSERT INTO cache_versions (name, version) VALUES (?, 1)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1
+    """, (name,))
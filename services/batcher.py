@@ -0,0 +1,207 @@
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+MAX_BATCH = 8       # most images generated by one pipeline call
+MAX_WAIT = 0.05     # seconds the oldest request waits for others to join its batch
+PREVIEW_EVERY = 5   # attach latent previews to every Nth progress event
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+class GenerationRequest:
+    def __init__(self, prompt, negative_prompt, width, height, guidance_scale, steps, num_images,
+                 seed=None, listener=None, job_id=None, timeout=None):
+        self.job_id = job_id
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.num_images = num_images
+        self.seed = seed
+        self.listener = listener  # called with progress events, if set
+        # Only requests with identical settings can share a pipeline call
+        self.key = (width, height, guidance_scale, steps)
+        self.enqueued_at = time.monotonic()
+        self.deadline = self.enqueued_at + timeout if timeout else None
+        self.future = Future()
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+
+class RequestBatcher:
+    """Collects concurrent requests and runs them as one batched `pipe` call.
+
+    Requests are grouped by (width, height, guidance_scale, steps). A batch is
+    sent once it holds `max_batch` images or its oldest request has waited
+    `max_wait` seconds, and the resulting images are split back per request.
+    `pipe` only needs the StableDiffusionPipeline call signature, so a tiny
+    stub is enough to exercise this on CPU (see tests/test_batcher.py).
+
+    Seeded requests get one generator per image from `make_generator(seed)`
+    (seed, seed + 1, ...), so they reproduce the same images whichever batch
+    they land in.
+
+    Requests with a `listener` receive {"type": "progress", "step", "total"}
+    events from the pipeline's step callback; every `preview_every` steps the
+    event also carries "previews", one `make_preview(latent)` per image.
+
+    `cancel(job_id)` resolves that job's requests with GenerationCancelled at
+    once; requests past their `timeout` get TimeoutError. Queued ones are
+    simply dropped. A running batch is interrupted at the next step only when
+    none of its requests is still wanted, otherwise it finishes for the rest.
+    """
+
+    def __init__(self, pipe, max_batch=MAX_BATCH, max_wait=MAX_WAIT, make_generator=None,
+                 make_preview=None, preview_every=PREVIEW_EVERY):
+        self.pipe = pipe
+        self.make_generator = make_generator
+        self.make_preview = make_preview
+        self.preview_every = preview_every
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = []
+        self._running = []
+        self._cond = threading.Condition()
+        threading.Thread(target=self._loop, name="batcher", daemon=True).start()
+
+    def enqueue(self, prompt, negative_prompt, width, height, guidance_scale, steps, num_images=2,
+                seed=None, listener=None, job_id=None, timeout=None):
+        """Queue a request; its `future` resolves to the list of images."""
+        req = GenerationRequest(prompt, negative_prompt, width, height, guidance_scale, steps,
+                                num_images, seed, listener, job_id, timeout)
+        with self._cond:
+            self._pending.append(req)
+            self._cond.notify()
+        return req
+
+    def submit(self, *args, **kwargs):
+        """Queue a request and block until its images are ready."""
+        return self.enqueue(*args, **kwargs).future.result()
+
+    def cancel_request(self, req, error=None):
+        """Give up on one request. Returns False if it had already finished."""
+        with self._cond:
+            if req.future.done():
+                return False
+            if req in self._pending:
+                self._pending.remove(req)
+            req.future.set_exception(error or GenerationCancelled(f"Job {req.job_id} was cancelled"))
+            return True
+
+    def cancel(self, job_id):
+        """Cancel every unfinished request of `job_id`; True if there was any."""
+        with self._cond:
+            found = [r for r in self._pending + self._running if r.job_id == job_id]
+        return any([self.cancel_request(r) for r in found])
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                for req in [r for r in self._pending if r.expired()]:
+                    self._pending.remove(req)
+                    req.future.set_exception(TimeoutError("Deadline passed while queued"))
+                if self._pending:
+                    break
+                self._cond.wait()
+
+            oldest = self._pending[0]
+            deadline = oldest.enqueued_at + self.max_wait
+            while True:
+                queued = sum(r.num_images for r in self._pending if r.key == oldest.key)
+                remaining = deadline - time.monotonic()
+                if queued >= self.max_batch or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, size = [], 0
+            for req in self._pending:
+                if req.key != oldest.key:
+                    continue
+                if batch and size + req.num_images > self.max_batch:
+                    break
+                batch.append(req)
+                size += req.num_images
+            self._pending = [r for r in self._pending if r not in batch]
+            self._running = batch
+            return batch
+
+    def _generators(self, batch):
+        if not self.make_generator or all(r.seed is None for r in batch):
+            return None
+        generators = []
+        for req in batch:
+            seed = req.seed if req.seed is not None else random.randrange(2 ** 32)
+            generators.extend(self.make_generator(seed + i) for i in range(req.num_images))
+        return generators
+
+    def _step_callback(self, batch, steps):
+        def callback(pipe, step, timestep, callback_kwargs):
+            for req in batch:
+                if req.expired():
+                    self.cancel_request(req, TimeoutError("Deadline passed"))
+            if all(req.future.done() for req in batch):
+                # Nobody is waiting for this batch any more: stop diffusing
+                raise GenerationCancelled("Every request in the batch was cancelled")
+
+            done = step + 1
+            latents = callback_kwargs.get("latents")
+            with_previews = (self.make_preview is not None and latents is not None
+                             and (done % self.preview_every == 0 or done == steps))
+            start = 0
+            for req in batch:
+                if req.listener and not req.future.done():
+                    event = {"type": "progress", "step": done, "total": steps}
+                    if with_previews:
+                        event["previews"] = [self.make_preview(latents[start + i])
+                                             for i in range(req.num_images)]
+                    try:
+                        req.listener(event)
+                    except Exception as e:
+                        print(f"Progress listener error: {e}")
+                start += req.num_images
+            return callback_kwargs
+        return callback
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            width, height, guidance_scale, steps = batch[0].key
+            extra = {}
+            generators = self._generators(batch)
+            if generators:
+                extra["generator"] = generators
+            # The step callback also checks for cancellation, so it is always set
+            extra["callback_on_step_end"] = self._step_callback(batch, steps)
+            if any(r.listener for r in batch):
+                extra["callback_on_step_end_tensor_inputs"] = ["latents"]
+            try:
+                images = self.pipe(
+                    prompt=[r.prompt for r in batch for _ in range(r.num_images)],
+                    negative_prompt=[r.negative_prompt for r in batch for _ in range(r.num_images)],
+                    guidance_scale=guidance_scale,
+                    width=width,
+                    height=height,
+                    num_inference_steps=steps,
+                    **extra
+                ).images
+            except Exception as e:
+                with self._cond:
+                    self._running = []
+                    for req in batch:
+                        if not req.future.done():
+                            req.future.set_exception(e)
+                continue
+
+            with self._cond:
+                self._running = []
+                start = 0
+                for req in batch:
+                    # Cancelled requests already have their answer
+                    if not req.future.done():
+                        req.future.set_result(images[start:start + req.num_images])
+                    start += req.num_images
@@ -0,0 +1,62 @@
+import base64
+import io
+import os
+import tempfile
+
+from PIL import Image, ImageFilter, features
+
+# Library thumbnails: each stored image also gets these widths (never wider
+# than the original) in every format below, plus a tiny blurred placeholder.
+DERIVATIVE_WIDTHS = (256, 384, 512)
+DERIVATIVE_FORMATS = ["webp"] + (["avif"] if features.check("avif") else [])
+_QUALITY = {"webp": 80, "avif": 60}
+PLACEHOLDER_WIDTH = 16
+
+
+def placeholder_uri(img):
+    """A ~16px wide blurred WebP of `img`, small enough to inline in the page."""
+    height = max(1, round(img.height * PLACEHOLDER_WIDTH / img.width))
+    small = img.resize((PLACEHOLDER_WIDTH, height), Image.BILINEAR).filter(ImageFilter.GaussianBlur(1))
+    buffer = io.BytesIO()
+    small.save(buffer, format="WEBP", quality=40)
+    return "data:image/webp;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def render_derivatives(src, spool_dir):
+    """Encode the thumbnails of image file `src` into `spool_dir`.
+
+    Returns {"width", "height", "placeholder", "files"}, where "files" is a
+    list of (spooled_path, width, format) for the caller to move into place.
+    """
+    os.makedirs(spool_dir, exist_ok=True)
+    files = []
+    try:
+        with Image.open(src) as original:
+            img = original.convert("RGB")
+        for width in DERIVATIVE_WIDTHS:
+            if width > img.width:
+                continue
+            resized = img if width == img.width else img.resize(
+                (width, round(img.height * width / img.width)), Image.LANCZOS)
+            for fmt in DERIVATIVE_FORMATS:
+                fd, path = tempfile.mkstemp(dir=spool_dir, prefix='.derivative-', suffix=f'.{fmt}')
+                files.append((path, width, fmt))
+                with os.fdopen(fd, 'wb') as f:
+                    resized.save(f, format=fmt.upper(), quality=_QUALITY[fmt])
+        return {
+            "width": img.width,
+            "height": img.height,
+            "placeholder": placeholder_uri(img),
+            "files": files,
+        }
+    except Exception:
+        discard_derivatives({"files": files})
+        raise
+
+
+def discard_derivatives(derived):
+    for path, _, _ in derived["files"]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,194 @@
+import threading
+import time
+
+from db.jobs import claim_job, finish_job, fail_job, requeue_job, take_followers, get_job, CANCELLED
+
+
+class JobDispatcher:
+    """Pool of worker threads draining `generation_jobs` into the backends.
+
+    There is one worker per slot across all of the router's backends. A
+    worker takes an endpoint from `router.acquire()` and then claims the
+    oldest queued job for it through `claim_job`, which also enforces the
+    endpoint's concurrency limit in the database, so several app processes
+    can run their own dispatcher against the same queue without
+    oversubscribing the GPU.
+
+    Work for a job is split in three callbacks:
+
+    - `fetch(job, backend)` runs inference and returns the raw output,
+    - `deliver(job, output, finish, fail)` stores that output for one job
+      and calls `finish(result)` with the JSON-serialisable result shown to
+      its owner, or `fail(error)`. It may do so later from another thread,
+      as long as it no longer needs `output` once it returns,
+    - `cleanup(output)` (optional) releases the raw output afterwards.
+
+    Jobs attached to the one being run (identical requests submitted while it
+    was in flight) are delivered the same output, so the GPU does the work
+    once while every owner still gets their own copy. If anything raises,
+    the affected jobs are marked failed and `on_failure(job)` is called so
+    the caller can return credits. Jobs cancelled in the meantime are left
+    alone; whoever cancelled them already settled their credit. A fetch
+    failing with one of the `retry_on` exceptions (the endpoint could not be
+    reached) puts the job back in the queue for another endpoint instead,
+    up to `max_attempts` tries. Only errors for which `blame(error)` is
+    true count against the endpoint's health (all of them by default), so
+    jobs dropped for their own reasons, like an expired deadline, don't get
+    a healthy endpoint ejected.
+    """
+
+    def __init__(self, router, fetch, deliver, cleanup=None, on_failure=None,
+                 poll_interval=1.0, lease_seconds=180, max_attempts=3, retry_on=(), blame=None):
+        self.router = router
+        self.fetch = fetch
+        self.deliver = deliver
+        self.cleanup = cleanup
+        self.on_failure = on_failure
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_on = tuple(retry_on)
+        self.blame = blame or (lambda error: True)
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        """Start the worker threads (and the router's health checks) once."""
+        with self._lock:
+            if self._threads:
+                return
+            self.router.start()
+            slots = sum(backend.concurrency for backend in self.router.backends)
+            for n in range(slots):
+                t = threading.Thread(target=self._worker, name=f"dispatcher-{n}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def stop(self, timeout=10):
+        """Let the workers finish their current job and exit; `start()` starts new ones."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+            self._stopping.set()
+            self._wakeup.set()
+        for t in threads:
+            t.join(timeout)
+        self._stopping.clear()
+
+    def notify(self):
+        """Wake idle workers after a job has been queued."""
+        self._wakeup.set()
+
+    def _worker(self):
+        while not self._stopping.is_set():
+            job = None
+            backend = self.router.acquire()
+            if backend:
+                try:
+                    job = claim_job(backend.url, backend.concurrency,
+                                    self.lease_seconds, self.max_attempts)
+                except Exception as e:
+                    print(f"Dispatcher claim error: {e}")
+
+            if job is None:
+                if backend:
+                    self.router.release(backend)
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            try:
+                self._run(job, backend)
+            except Exception as e:
+                # Most likely the database stayed locked past its timeout.
+                # Don't let it take the worker down with it.
+                print(f"Dispatcher error on job {job['id']}: {e}")
+                self._abandon(job, e)
+
+    def complete(self, job, output):
+        """Deliver `output` to a job that never went through the queue.
+
+        For results the caller already has, e.g. from a cache; `job` should
+        have been created running so no worker claims it meanwhile.
+        """
+        try:
+            self._deliver(job, output)
+        finally:
+            if self.cleanup:
+                self.cleanup(output)
+
+    def _cancelled(self, job):
+        current = get_job(job['id'])
+        return current is None or current['status'] == CANCELLED
+
+    def _fail(self, job, error):
+        if not fail_job(job['id'], error):
+            # Finished or cancelled meanwhile; its credit is settled already
+            return
+        if self.on_failure:
+            try:
+                self.on_failure(job)
+            except Exception as hook_error:
+                print(f"Job failure hook error: {hook_error}")
+
+    def _run(self, job, backend):
+        started = time.monotonic()
+        try:
+            output = self.fetch(job, backend)
+        except Exception as e:
+            cancelled = False
+            try:
+                cancelled = self._cancelled(job)
+            finally:
+                # Cancelling a job cuts its request short; that is not the endpoint's fault
+                self.router.release(backend, failed=not cancelled and self.blame(e), error=e)
+            if not cancelled:
+                if isinstance(e, self.retry_on) and job['attempts'] < self.max_attempts:
+                    print(f"Retrying job {job['id']} after {backend.url} failed: {e}")
+                    requeue_job(job['id'])
+                    self.notify()
+                    return
+                print(f"Error generating images for job {job['id']}: {e}")
+            self._fail(job, e)
+            for follower in take_followers(job['id']):
+                self._fail(follower, e)
+            return
+        self.router.release(backend, latency=time.monotonic() - started)
+
+        try:
+            # Taken before the leader is delivered, in the same transaction
+            # that stops new ones attaching, so none can be left behind
+            followers = take_followers(job['id'])
+            self._deliver(job, output)
+            for follower in followers:
+                self._deliver(follower, output)
+        finally:
+            if self.cleanup:
+                self.cleanup(output)
+
+    def _abandon(self, job, error):
+        """Fail a job whose run broke off, if the database lets us.
+
+        If it doesn't, the job's lease runs out and `claim_job` requeues it.
+        """
+        try:
+            self._fail(job, error)
+        except Exception as e:
+            print(f"Error failing job {job['id']}: {e}")
+
+    def _deliver(self, job, output):
+        if self._cancelled(job):
+            return
+
+        def finish(result):
+            finish_job(job['id'], result)
+
+        def fail(error):
+            self._fail(job, error)
+
+        try:
+            self.deliver(job, output, finish, fail)
+        except Exception as e:
+            print(f"Error storing images for job {job['id']}: {e}")
+            self._fail(job, e)
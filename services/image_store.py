@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import re
+
+from services.derivatives import discard_derivatives
+
+STORE_DIR = "generated"
+# generated/ab/cd/<sha256>.png and its thumbnails, <sha256>_<width>.<fmt>
+_STORED_NAME = re.compile(rf"{STORE_DIR}/([0-9a-f]{{2}})/([0-9a-f]{{2}})/(\1\2[0-9a-f]{{60}})(_\d+)?\.[a-z]+")
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ImageStore:
+    """Content-addressed image files with reference counts in `image_blobs`.
+
+    A file is stored once under generated/ab/cd/<sha256>.png (paths are
+    relative to `static_folder`, like `generations.image_path`), however
+    many generations or cache entries point at it. Every holder takes a
+    reference with `add()` and gives it back with `release()`; the file is
+    unlinked when the last one is gone, along with the thumbnails recorded
+    for it by `attach_derivatives()`.
+
+    All methods work on the caller's cursor, inside a write transaction
+    (BEGIN IMMEDIATE), so the file system and the counts change under the
+    same database lock. `release()` only says which files to remove; pass
+    them to `unlink()` just before committing.
+    """
+
+    def __init__(self, static_folder="static"):
+        self.static_folder = static_folder
+
+    def relative_path(self, digest):
+        return f"{STORE_DIR}/{digest[:2]}/{digest[2:4]}/{digest}.png"
+
+    def derivative_path(self, digest, width, fmt):
+        return f"{STORE_DIR}/{digest[:2]}/{digest[2:4]}/{digest}_{width}.{fmt}"
+
+    def full_path(self, relative_path):
+        return os.path.join(self.static_folder, relative_path)
+
+    def content_addressed(self, relative_path):
+        """True for a path the store named after the file's content, whose
+        bytes never change; older images can be rewritten under their name."""
+        return _STORED_NAME.fullmatch(relative_path) is not None
+
+    def add(self, cursor, src, digest=None, added=None):
+        """Move the file `src` into the store and take a reference to it.
+
+        `src` is consumed either way. Returns the stored relative path. If
+        the store had no copy yet, the new file's path is appended to the
+        list `added`, if given: rolling back forgets its blob row, so pass
+        them to `unlink()` before you do.
+        """
+        digest = digest or file_digest(src)
+        relative_path = self.relative_path(digest)
+        dest = self.full_path(relative_path)
+        # Same name means same bytes, so an existing copy is as good as ours.
+        # (Releases unlink under the same write lock, so it can't vanish now.)
+        if os.path.exists(dest):
+            os.remove(src)
+        else:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(src, dest)
+            if added is not None:
+                added.append(dest)
+        cursor.execute("""
+            INSERT INTO image_blobs (hash, path, size, refcount)
+            VALUES (?, ?, ?, 1)
+            ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1
+        """, (digest, relative_path, os.path.getsize(dest)))
+        return relative_path
+
+    def has_derivatives(self, cursor, digest):
+        cursor.execute("SELECT variants FROM image_blobs WHERE hash = ?", (digest,))
+        row = cursor.fetchone()
+        return bool(row and row[0])
+
+    def attach_derivatives(self, cursor, digest, derived):
+        """Move thumbnails from `render_derivatives()` into place for a stored file.
+
+        They are dropped if the file already has its own, or is gone.
+        """
+        cursor.execute("SELECT variants FROM image_blobs WHERE hash = ?", (digest,))
+        row = cursor.fetchone()
+        if not row or row[0]:
+            discard_derivatives(derived)
+            return
+        variants = []
+        for path, width, fmt in derived["files"]:
+            relative_path = self.derivative_path(digest, width, fmt)
+            os.replace(path, self.full_path(relative_path))
+            variants.append({"width": width, "format": fmt, "path": relative_path})
+        cursor.execute("""
+            UPDATE image_blobs SET width = ?, height = ?, placeholder = ?, variants = ?
+            WHERE hash = ?
+        """, (derived["width"], derived["height"], derived["placeholder"],
+              json.dumps(variants), digest))
+
+    def release(self, cursor, relative_path):
+        """Drop one reference; returns the files that are no longer used.
+
+        Images saved before the store existed have no blob row and belong to
+        a single generation, so they are released right away.
+        """
+        cursor.execute("SELECT hash, refcount, variants FROM image_blobs WHERE path = ?", (relative_path,))
+        row = cursor.fetchone()
+        if not row:
+            return [self.full_path(relative_path)]
+        if row[1] > 1:
+            cursor.execute("UPDATE image_blobs SET refcount = refcount - 1 WHERE hash = ?", (row[0],))
+            return []
+        cursor.execute("DELETE FROM image_blobs WHERE hash = ?", (row[0],))
+        variants = json.loads(row[2]) if row[2] else []
+        return [self.full_path(relative_path)] + [self.full_path(v["path"]) for v in variants]
+
+    def unlink(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
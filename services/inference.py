@@ -0,0 +1,166 @@
+import base64
+import json
+import os
+import struct
+import tempfile
+
+import requests
+
+# Binary wire format spoken by the inference server when the request's Accept
+# header asks for it: a sequence of frames, each a 4-byte big-endian length
+# followed by that many bytes. Zero or more JSON progress frames
+# ({"type": "progress", "step", "total", "previews"?}) come first, then a
+# JSON header ({"type": "images", "count": N, "content_type": "image/png"})
+# and finally N frames holding the raw image files. A request that is
+# cancelled or runs past its deadline ends with {"type": "error", "error"}
+# instead of the images header. Servers that don't know
+# the format keep answering with the original JSON body of base64 strings,
+# which is still accepted.
+FRAMES_MIME = 'application/x-pixtrix-frames'
+_LENGTH = struct.Struct('>I')
+
+
+class JobDropped(Exception):
+    """The job was given up for its own reasons (cancelled, past its deadline).
+
+    Says nothing about the endpoint's health.
+    """
+
+
+def endpoint_failed(error):
+    """Whether an error from fetch_images() counts against the endpoint.
+
+    Only transport errors (connection refused or reset, timeouts, a stream
+    cut short) and 5xx answers do. Dropped jobs and 4xx answers are about
+    the request, not the server.
+    """
+    if isinstance(error, JobDropped):
+        return False
+    if isinstance(error, requests.HTTPError):
+        return error.response is None or error.response.status_code >= 500
+    return isinstance(error, (requests.RequestException, IOError))
+
+
+class FrameReader:
+    """Reads length-prefixed frames from a streamed response body."""
+
+    def __init__(self, raw, chunk_size=64 * 1024):
+        self.raw = raw
+        self.chunk_size = chunk_size
+
+    def _read(self, n):
+        data = self.raw.read(n)
+        if data is None:
+            data = b''
+        return data
+
+    def _read_exact(self, n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self._read(n - len(buf))
+            if not chunk:
+                raise IOError("Inference stream ended mid-frame")
+            buf += chunk
+        return bytes(buf)
+
+    def frame_length(self):
+        """Length of the next frame, or None at a clean end of stream."""
+        first = self._read(_LENGTH.size)
+        if not first:
+            return None
+        if len(first) < _LENGTH.size:
+            first += self._read_exact(_LENGTH.size - len(first))
+        return _LENGTH.unpack(first)[0]
+
+    def read_json(self):
+        length = self.frame_length()
+        if length is None:
+            raise IOError("Inference stream is empty")
+        return json.loads(self._read_exact(length))
+
+    def copy_frame(self, out, length):
+        """Copy the next `length` bytes to the file object `out` chunk by chunk."""
+        remaining = length
+        while remaining:
+            chunk = self._read(min(self.chunk_size, remaining))
+            if not chunk:
+                raise IOError("Inference stream ended mid-frame")
+            out.write(chunk)
+            remaining -= len(chunk)
+
+
+def _spool(dest_dir):
+    fd, path = tempfile.mkstemp(dir=dest_dir, prefix='.incoming-', suffix='.png')
+    return os.fdopen(fd, 'wb'), path
+
+
+def fetch_images(url, payload, dest_dir, timeout, binary=True, headers=None, http=requests,
+                 on_progress=None):
+    """POST a generation request and write every returned image into `dest_dir`.
+
+    With `binary` the server is asked for the framed format and each image is
+    streamed straight to its file; progress frames received before the
+    images are passed to `on_progress`. Otherwise (or if the server answers
+    with JSON anyway) the base64 strings are decoded and written. Returns the
+    list of file paths; the caller is responsible for moving or removing them.
+    """
+    headers = dict(headers or {})
+    if binary:
+        headers['Accept'] = f'{FRAMES_MIME}, application/json;q=0.5'
+    os.makedirs(dest_dir, exist_ok=True)
+
+    paths = []
+    try:
+        with http.post(url, json=payload, headers=headers, timeout=timeout, stream=True) as r:
+            r.raise_for_status()
+            if r.headers.get('Content-Type', '').startswith(FRAMES_MIME):
+                r.raw.decode_content = True
+                reader = FrameReader(r.raw)
+                header = reader.read_json()
+                while header.get('type') == 'progress':
+                    if on_progress:
+                        try:
+                            on_progress(header)
+                        except Exception as e:
+                            print(f"Progress handler error: {e}")
+                    header = reader.read_json()
+                if header.get('type') == 'error':
+                    raise JobDropped(f"Inference server: {header.get('error')}")
+                for _ in range(int(header.get('count', 0))):
+                    length = reader.frame_length()
+                    if length is None:
+                        raise IOError("Inference stream ended before all images arrived")
+                    f, path = _spool(dest_dir)
+                    paths.append(path)
+                    with f:
+                        reader.copy_frame(f, length)
+            else:
+                for encoded in r.json().get('images', []):
+                    f, path = _spool(dest_dir)
+                    paths.append(path)
+                    with f:
+                        f.write(base64.b64decode(encoded))
+    except Exception:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        raise
+    return paths
+
+
+def sibling_url(generate_url, path):
+    """Another route of the inference server that serves `generate_url`."""
+    return generate_url.rstrip('/').rsplit('/', 1)[0] + path
+
+
+def cancel_remote(generate_url, job_id, timeout=5, headers=None, http=requests):
+    """Ask the inference server to drop `job_id`. Returns True if it was still running there."""
+    try:
+        r = http.post(sibling_url(generate_url, f'/cancel/{job_id}'), headers=headers, timeout=timeout)
+        r.raise_for_status()
+        return bool(r.json().get('cancelled'))
+    except Exception as e:
+        print(f"Error cancelling job {job_id} on {generate_url}: {e}")
+        return False
@@ -0,0 +1,163 @@
+import os
+import queue
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from db.database import get_connection
+from services.derivatives import render_derivatives, discard_derivatives
+
+
+def link_or_copy(src, dest):
+    """Hard-link `src` to `dest`, copying instead across filesystems."""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+    return dest
+
+
+def private_copy(path, tag):
+    """A second name for a spooled file, so one delivery can move it away."""
+    return link_or_copy(path, f"{path}-{tag}")
+
+
+class GenerationWriter:
+    """Background thread that stores finished generations.
+
+    `submit()` takes the spooled image files of a job as (path, sha256)
+    pairs and the `generations` rows that go with them, and returns as soon
+    as the work is queued. The writer moves the files into `store` and
+    inserts the rows of up to `batch_size` queued submissions in a single
+    transaction, then calls each submission's `on_done()`, or
+    `on_error(error)` if its part failed. The queue holds at most
+    `max_pending` submissions; past that `submit()` blocks, which slows the
+    dispatcher instead of piling up files.
+
+    Library thumbnails are encoded afterwards by `render_workers` threads
+    of their own, so they never hold up a delivery; until they are in
+    place the library shows the original.
+    """
+
+    def __init__(self, store, spool_dir, max_pending=64, batch_size=32, render_workers=1):
+        self.store = store
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self._renderer = ThreadPoolExecutor(max_workers=render_workers, thread_name_prefix="thumbnail-renderer")
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Start the writer thread once; later calls are no-ops."""
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._loop, name="generation-writer", daemon=True)
+            self._thread.start()
+
+    def submit(self, files, rows, on_done=None, on_error=None):
+        self.start()
+        self._queue.put((files, rows, on_done, on_error))
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"Generation writer error: {e}")
+
+    def _render(self, digest):
+        """Encode the thumbnails of a stored file that has none yet."""
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            if self.store.has_derivatives(cursor, digest):
+                return
+            # The encoding runs without the write lock, which is only taken
+            # to move the results into place
+            derived = render_derivatives(self.store.full_path(self.store.relative_path(digest)),
+                                         self.spool_dir)
+            try:
+                cursor.execute('BEGIN IMMEDIATE')
+                self.store.attach_derivatives(cursor, digest, derived)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                discard_derivatives(derived)
+                raise
+        except Exception as e:
+            # The original is still stored; the library falls back to it
+            print(f"Error rendering thumbnails for {digest}: {e}")
+        finally:
+            conn.close()
+
+    def _write(self, batch):
+        stored, failed = [], []
+        added = []      # files new to the store, taken out again if the batch is rolled back
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            for item in batch:
+                files, rows = item[0], item[1]
+                job_added = []
+                # A savepoint per job keeps one bad job from failing the batch
+                cursor.execute('SAVEPOINT job')
+                try:
+                    for path, digest in files:
+                        self.store.add(cursor, path, digest, added=job_added)
+                    cursor.executemany("""
+                        INSERT INTO generations (user_id, prompt, image_path, aspect_ratio, width, height)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    """, rows)
+                    cursor.execute('RELEASE job')
+                    stored.append(item)
+                    added.extend(job_added)
+                except Exception as e:
+                    # Still under the write lock, so no other job can have
+                    # taken a reference to the files it brought in
+                    self.store.unlink(job_added)
+                    cursor.execute('ROLLBACK TO job')
+                    cursor.execute('RELEASE job')
+                    # The spooled files add() didn't get to
+                    self.store.unlink(path for path, _ in files)
+                    failed.append((item, e))
+            conn.commit()
+        except Exception as e:
+            self.store.unlink(added)
+            conn.rollback()
+            # Every job not failed on its own yet fails with the batch
+            done = {id(item) for item, _ in failed}
+            for item in batch:
+                if id(item) not in done:
+                    self.store.unlink(path for path, _ in item[0])
+                    failed.append((item, e))
+            stored = []
+        finally:
+            conn.close()
+
+        for files, rows, on_done, on_error in stored:
+            self._call(on_done)
+        for digest in {digest for files, *_ in stored for _, digest in files}:
+            self._renderer.submit(self._render, digest)
+        for (files, rows, on_done, on_error), error in failed:
+            print(f"Error storing generation: {error}")
+            self._call(on_error, error)
+
+    def _call(self, callback, *args):
+        if callback:
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Generation writer callback error: {e}")
@@ -0,0 +1,143 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, features
+
+# Formats `/img/<id>` can return, with their MIME types
+FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+if features.check("avif"):
+    FORMATS["avif"] = "image/avif"
+_QUALITY = {"webp": 80, "jpeg": 85, "avif": 60}
+
+MIN_WIDTH = 16
+MAX_WIDTH = 2048
+WIDTH_STEP = 32     # requested widths are rounded up to this, to bound the variants
+STALE_RENDER = 600  # seconds after which a temporary render file is taken for abandoned
+
+
+def normalize_width(width):
+    width = min(max(int(width), MIN_WIDTH), MAX_WIDTH)
+    return -(-width // WIDTH_STEP) * WIDTH_STEP
+
+
+class ImageResizer:
+    """Resized copies of stored images, rendered on demand and kept on disk.
+
+    `get()` returns the path of `src` scaled down to `width` (never up) in
+    `fmt`. Outputs are cached in `cache_dir` up to `max_bytes`, evicting the
+    least recently used ones. Misses are rendered by a pool of `workers`
+    threads (Pillow releases the GIL while it resamples and encodes), and
+    concurrent requests for the same missing output wait on one render
+    instead of each starting their own.
+
+    Every app process can share `cache_dir`: sizes and the LRU order are
+    read from the files themselves (a hit bumps the file's mtime), so the
+    processes stay under `max_bytes` together, and an output another one
+    evicted is simply rendered again.
+    """
+
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024, workers=2, timeout=30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-resizer")
+        self._lock = threading.Lock()
+        self._pending = {}              # name -> Future of a render in progress
+        self._usage = (0, 0)            # (entries, bytes) in the cache as of the last scan
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._evict()
+
+    def _name(self, src, width, fmt):
+        key = f"{src}|{width}|{fmt}".encode()
+        return f"{hashlib.sha256(key).hexdigest()}.{fmt}"
+
+    def get(self, src, width, fmt):
+        """Path of the cached rendition of `src`; renders it first on a miss."""
+        path = os.path.join(self.cache_dir, self._name(src, normalize_width(width), fmt))
+        try:
+            # Keeps its place in the LRU order, and fails if it isn't there
+            os.utime(path)
+        except OSError:
+            return self.render(src, width, fmt)
+        return path
+
+    def render(self, src, width, fmt):
+        """Render `src` even if it is cached, e.g. when the file `get()`
+        returned was evicted before it could be read."""
+        width = normalize_width(width)
+        name = self._name(src, width, fmt)
+        with self._lock:
+            future = self._pending.get(name)
+            if not future:
+                future = self._pool.submit(self._render, src, name, width, fmt)
+                self._pending[name] = future
+        return future.result(timeout=self.timeout)
+
+    def _render(self, src, name, width, fmt):
+        path = os.path.join(self.cache_dir, name)
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.resize-', suffix=f'.{fmt}')
+            try:
+                with Image.open(src) as img:
+                    if fmt != "png":
+                        img = img.convert("RGB")
+                    if width < img.width:
+                        img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+                    with os.fdopen(fd, 'wb') as f:
+                        img.save(f, format=fmt.upper(), **({"quality": _QUALITY[fmt]} if fmt in _QUALITY else {}))
+                os.replace(tmp, path)
+            except Exception:
+                _remove(tmp)
+                raise
+
+            self._evict(keep=name)
+            return path
+        finally:
+            with self._lock:
+                self._pending.pop(name, None)
+
+    def _evict(self, keep=None):
+        # Scans the directory, so outputs written and evicted by the other
+        # processes count as well
+        now = time.time()
+        found = []
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue    # evicted meanwhile
+                if entry.name.startswith('.'):
+                    # A render in progress, or one left unfinished by a crash
+                    if now - stat.st_mtime > STALE_RENDER:
+                        _remove(entry.path)
+                    continue
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+
+        entries, size = len(found), sum(file_size for _, _, file_size in found)
+        for _, name, file_size in sorted(found):
+            if size <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            _remove(os.path.join(self.cache_dir, name))
+            entries -= 1
+            size -= file_size
+        self._usage = (entries, size)
+
+    def stats(self):
+        entries, size = self._usage
+        with self._lock:
+            return {"entries": entries, "bytes": size,
+                    "max_bytes": self.max_bytes, "rendering": len(self._pending)}
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
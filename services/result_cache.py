@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from db.database import get_connection
+from services.image_store import file_digest
+from services.persistence import private_copy
+
+
+def cache_key(prompt, negative_prompt, guidance_scale, aspect, steps, seed, model):
+    """Hash every input that determines the generated pixels."""
+    raw = json.dumps([prompt, negative_prompt, guidance_scale, aspect, steps, seed, model])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Content-addressed cache of finished generations.
+
+    Entries live in the `result_cache` table and hold references to their
+    images in the shared ImageStore, so a user deleting a library image
+    never invalidates the cache, and a cached result that is also in
+    someone's library is stored only once. At most `max_entries` results
+    are kept; the least recently used ones are evicted first. Only seeded
+    requests are worth caching, since unseeded ones never produce the same
+    images twice.
+    """
+
+    def __init__(self, store, max_entries=500):
+        self.images = store
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def lookup(self, key):
+        """Return the cached image paths for `key`, or None on a miss."""
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT image_paths FROM result_cache WHERE key = ?', (key,))
+            row = cursor.fetchone()
+            paths = [self.images.full_path(p) for p in json.loads(row[0])] if row else None
+            if paths and all(os.path.exists(p) for p in paths):
+                cursor.execute("""
+                    UPDATE result_cache SET hits = hits + 1, last_used_at = ?
+                    WHERE key = ?
+                """, (time.time(), key))
+                conn.commit()
+                self._count('hits')
+                return paths
+            if row:
+                # Files went missing underneath us; forget the entry
+                cursor.execute('BEGIN IMMEDIATE')
+                self._drop(cursor, [key])
+                conn.commit()
+        finally:
+            conn.close()
+        self._count('misses')
+        return None
+
+    def store(self, key, paths):
+        """Add freshly generated images to the cache under `key`."""
+        files = [(private_copy(path, 'cache'), file_digest(path)) for path in paths]
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            doomed = self._drop(cursor, [key])
+            cached = [self.images.add(cursor, path, digest) for path, digest in files]
+            cursor.execute("""
+                INSERT INTO result_cache (key, image_paths, last_used_at)
+                VALUES (?, ?, ?)
+            """, (key, json.dumps(cached), time.time()))
+            self.images.unlink(doomed)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            for path, _ in files:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        finally:
+            conn.close()
+        self._evict()
+
+    def _drop(self, cursor, keys):
+        """Delete entries and release their images; returns the files to unlink."""
+        doomed = []
+        for key in keys:
+            cursor.execute('SELECT image_paths FROM result_cache WHERE key = ?', (key,))
+            row = cursor.fetchone()
+            if not row:
+                continue
+            for path in json.loads(row[0]):
+                doomed.extend(self.images.release(cursor, path))
+            cursor.execute('DELETE FROM result_cache WHERE key = ?', (key,))
+        return doomed
+
+    def _evict(self):
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT COUNT(*) FROM result_cache')
+            excess = cursor.fetchone()[0] - self.max_entries
+            if excess <= 0:
+                conn.commit()
+                return
+            cursor.execute("""
+                SELECT key FROM result_cache
+                ORDER BY last_used_at LIMIT ?
+            """, (excess,))
+            victims = [row[0] for row in cursor.fetchall()]
+            self.images.unlink(self._drop(cursor, victims))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        for _ in victims:
+            self._count('evictions')
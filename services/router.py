@@ -0,0 +1,185 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from services.inference import sibling_url
+
+# Circuit breaker states
+CLOSED = 'closed'   # healthy, takes jobs
+OPEN = 'open'       # ejected after repeated failures, waiting out the cooldown
+
+
+class Backend:
+    """An inference endpoint and the number of jobs it may run at once.
+
+    Each one keeps its own keep-alive session, plus the load and health
+    figures the router needs to pick between endpoints.
+    """
+
+    def __init__(self, url, concurrency=1):
+        self.url = url
+        self.concurrency = max(1, int(concurrency))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency + 2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.in_flight = 0
+        self.latency = None         # moving average of job durations, in seconds
+        self.failures = 0           # consecutive failed jobs or health checks
+        self.state = CLOSED
+        self.opened_at = None
+        self.last_error = None
+
+    def __repr__(self):
+        return f"Backend({self.url!r}, concurrency={self.concurrency})"
+
+
+def parse_backends(spec, default_concurrency=1):
+    """Parse "url1|2, url2" into Backend objects.
+
+    Each comma-separated entry is an endpoint URL with an optional
+    "|N" suffix overriding the default concurrency for that endpoint.
+    """
+    backends = []
+    for entry in (spec or '').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, _, concurrency = entry.partition('|')
+        backends.append(Backend(url.strip(), concurrency.strip() or default_concurrency))
+    return backends
+
+
+class InferenceRouter:
+    """Spreads jobs over several inference endpoints.
+
+    `acquire()` hands out the least-loaded endpoint with a free slot,
+    scoring each by its in-flight jobs times its moving-average latency, and
+    `release()` reports how the job went. After `failure_threshold`
+    consecutive failures an endpoint's circuit opens and it gets no jobs for
+    `cooldown` seconds; after that a single trial job (or a passing health
+    check) decides whether it rejoins. A background thread polls every
+    endpoint's /health route every `check_interval` seconds, so a dead
+    endpoint is ejected before jobs are sent to it and a recovered one comes
+    back on its own.
+    """
+
+    def __init__(self, backends, headers=None, check_interval=10, check_timeout=5,
+                 failure_threshold=3, cooldown=30, latency_alpha=0.2):
+        self.backends = backends
+        self.headers = headers
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.latency_alpha = latency_alpha
+        self._lock = threading.Lock()
+        self._checker = None
+
+    def start(self):
+        """Start the health checker once; later calls are no-ops."""
+        with self._lock:
+            if self._checker or not self.check_interval:
+                return
+            self._checker = threading.Thread(target=self._check_loop, name="router-health", daemon=True)
+            self._checker.start()
+
+    def get(self, url):
+        for backend in self.backends:
+            if backend.url == url:
+                return backend
+        return None
+
+    def _available(self, backend, now):
+        if backend.state == CLOSED:
+            return backend.in_flight < backend.concurrency
+        # Open circuit: once cooled down, let one trial job through
+        return now - backend.opened_at >= self.cooldown and backend.in_flight == 0
+
+    def _score(self, backend):
+        # Endpoints without a latency sample yet look as fast as the fastest one
+        known = [b.latency for b in self.backends if b.latency is not None]
+        latency = backend.latency if backend.latency is not None else min(known, default=1.0)
+        return (backend.in_flight + 1) * latency
+
+    def acquire(self):
+        """Reserve a slot on the best endpoint, or return None if none is free."""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [b for b in self.backends if self._available(b, now)]
+            if not candidates:
+                return None
+            backend = min(candidates, key=self._score)
+            backend.in_flight += 1
+            return backend
+
+    def release(self, backend, latency=None, failed=False, error=None):
+        """Free a slot taken by `acquire()`.
+
+        Pass the job's `latency` when it succeeded or `failed=True` when the
+        endpoint let it down; leave both out if the slot went unused.
+        """
+        with self._lock:
+            backend.in_flight -= 1
+            if failed:
+                self._record_failure(backend, error)
+            elif latency is not None:
+                self._record_success(backend)
+                if backend.latency is None:
+                    backend.latency = latency
+                else:
+                    backend.latency += self.latency_alpha * (latency - backend.latency)
+
+    def _record_failure(self, backend, error):
+        backend.failures += 1
+        backend.last_error = str(error) if error else None
+        if backend.state == OPEN or backend.failures >= self.failure_threshold:
+            if backend.state != OPEN:
+                print(f"Inference endpoint {backend.url} ejected: {backend.last_error}")
+            backend.state = OPEN
+            backend.opened_at = time.monotonic()
+
+    def _record_success(self, backend):
+        backend.failures = 0
+        if backend.state == OPEN:
+            print(f"Inference endpoint {backend.url} is back")
+            backend.state = CLOSED
+            backend.opened_at = None
+
+    def check(self, backend):
+        """Probe one endpoint's /health route and update its circuit."""
+        try:
+            r = backend.session.get(sibling_url(backend.url, '/health'),
+                                    headers=self.headers, timeout=self.check_timeout)
+            r.raise_for_status()
+        except Exception as e:
+            with self._lock:
+                self._record_failure(backend, e)
+            return False
+
+        with self._lock:
+            # A passing check only readmits an ejected endpoint after its cooldown
+            if backend.state == CLOSED or time.monotonic() - backend.opened_at >= self.cooldown:
+                self._record_success(backend)
+        return True
+
+    def _check_loop(self):
+        while True:
+            for backend in self.backends:
+                self.check(backend)
+            time.sleep(self.check_interval)
+
+    def stats(self):
+        with self._lock:
+            return [{
+                "url": b.url,
+                "state": b.state,
+                "in_flight": b.in_flight,
+                "concurrency": b.concurrency,
+                "latency": b.latency,
+                "failures": b.failures,
+                "last_error": b.last_error,
+            } for b in self.backends]
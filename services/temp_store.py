@@ -0,0 +1,65 @@
+import os
+import re
+import secrets
+import threading
+import time
+
+from services.persistence import link_or_copy
+
+_NAME = re.compile(r'^[A-Za-z0-9_-]+\.png$')
+
+
+class TempImageStore:
+    """Short-lived image files for guests, served under unguessable names.
+
+    Guests have no library, so their results are only kept for `ttl`
+    seconds; whoever holds the random name can fetch the file until then.
+    Expired files are swept at most every `sweep_interval` seconds, from
+    `put()`, so no extra thread is needed.
+    """
+
+    def __init__(self, folder, ttl=900, sweep_interval=60):
+        self.folder = folder
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0
+        self._lock = threading.Lock()
+
+    def put(self, path):
+        """Keep a copy of `path` and return its public name."""
+        os.makedirs(self.folder, exist_ok=True)
+        self.sweep()
+        name = f"{secrets.token_urlsafe(16)}.png"
+        link_or_copy(path, os.path.join(self.folder, name))
+        return name
+
+    def path(self, name):
+        """File behind `name`, or None if it is unknown or expired."""
+        if not _NAME.match(name):
+            return None
+        path = os.path.join(self.folder, name)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+        except OSError:
+            return None
+        return path
+
+    def sweep(self):
+        with self._lock:
+            now = time.time()
+            if now - self._last_sweep < self.sweep_interval:
+                return
+            self._last_sweep = now
+
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.folder, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
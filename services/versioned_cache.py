@@ -0,0 +1,36 @@
+import threading
+
+from db.database import get_connection
+from db.versions import read_version
+
+
+class VersionedCache:
+    """An in-memory copy of rarely changing data, shared by every request.
+
+    `get()` costs one primary-key read of the `name` counter in
+    cache_versions and only calls `load()` again when the counter has moved,
+    so every worker process picks up a change on its next request.
+    """
+
+    def __init__(self, name, load):
+        self.name = name
+        self.load = load
+        self._lock = threading.Lock()
+        self._version = None
+        self._value = None
+
+    def get(self):
+        conn = get_connection()
+        try:
+            version = read_version(conn.cursor(), self.name)
+        finally:
+            conn.close()
+
+        with self._lock:
+            if self._version == version:
+                return self._value
+        # Loaded after reading the version, so it is at least that new
+        value = self.load()
+        with self._lock:
+            self._version, self._value = version, value
+        return value
@@ -70,12 +70,14 @@ function updateImageSlot(slotNum, img) {
       slot.appendChild(downloadBtn);
     }
     
-    // Update elements
-    imgElement.src = img;
+    // Update elements (img is {url, width, height})
+    imgElement.src = img.url;
+    imgElement.width = img.width;
+    imgElement.height = img.height;
     imgElement.alt = `Generated image ${slotNum}`;
     imgElement.style.display = 'block';
     
-    downloadBtn.href = img;
+    downloadBtn.href = img.url;
     downloadBtn.download = `pixtrix_${slotNum}.png`;
     downloadBtn.style.display = 'block';
     
@@ -104,11 +106,65 @@ function resetImageSlots() {
       
       // Reset overlay
       overlay.style.display = 'none';
+      overlay.style.backgroundImage = '';
+      const loadingText = overlay.querySelector('.loading-text');
+      if (loadingText) loadingText.textContent = 'GENERATING';
       slot.classList.remove('has-image');
     }
   }
 }
 
+// Poll a queued generation job until it is done or failed
+async function waitForJob(jobId) {
+  while (true) {
+    const response = await fetch(`/jobs/${jobId}`);
+    const data = await response.json();
+    if (!response.ok || data.status === 'failed' || data.status === 'cancelled') {
+      return { ok: false, data };
+    }
+    if (data.status === 'done') {
+      return { ok: true, data };
+    }
+    await new Promise(resolve => setTimeout(resolve, 1000));
+  }
+}
+
+// Show diffusion progress (and latent previews, when sent) on the slot overlays
+function showProgress(progress) {
+  for (let i = 1; i <= 2; i++) {
+    const overlay = document.getElementById(`overlay${i}`);
+    if (!overlay) continue;
+    const loadingText = overlay.querySelector('.loading-text');
+    if (loadingText && progress.total) {
+      loadingText.textContent = `GENERATING ${Math.round(100 * progress.step / progress.total)}%`;
+    }
+    if (progress.previews && progress.previews[i - 1]) {
+      overlay.style.backgroundImage = `url(${progress.previews[i - 1]})`;
+      overlay.style.backgroundSize = 'cover';
+      overlay.style.backgroundPosition = 'center';
+    }
+  }
+}
+
+// Follow a job over Server-Sent Events, falling back to polling
+function watchJob(jobId, onProgress) {
+  if (!window.EventSource) {
+    return waitForJob(jobId);
+  }
+  return new Promise(resolve => {
+    const events = new EventSource(`/jobs/${jobId}/events`);
+    events.addEventListener('progress', e => onProgress(JSON.parse(e.data)));
+    events.addEventListener('finished', () => {
+      events.close();
+      waitForJob(jobId).then(resolve);
+    });
+    events.onerror = () => {
+      events.close();
+      waitForJob(jobId).then(resolve);
+    };
+  });
+}
+
 // Form submission handler
 async function handleFormSubmit(e) {
   e.preventDefault();
@@ -151,8 +207,8 @@ async function handleFormSubmit(e) {
   // Prepare form data
   const formData = new FormData(form);
   try {
-    // Send AJAX request
-    const response = await fetch('/home', {
+    // Queue the generation job
+    const response = await fetch('/jobs', {
       method: 'POST',
       headers: {
         'X-Requested-With': 'XMLHttpRequest'
@@ -160,11 +216,16 @@ async function handleFormSubmit(e) {
       body: formData
     });
     
-    const data = await response.json();
+    let data = await response.json();
+    let ok = response.ok;
+
+    // Wait for the queued job to finish
+    if (ok) {
+      ({ ok, data } = await watchJob(data.job_id, showProgress));
+    }
 
-    if (!response.ok) {
+    if (!ok) {
       // Revert credit count on failure
-      const data = await response.json();
       creditCountEl.innerHTML = `<i class="fas fa-bolt" style="margin-right: 10px;"></i>${currentCredits}`;
       if (data.error) {
         showMatrixAlert(data.error);
@@ -0,0 +1,115 @@
+import io
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+import pytest
+from flask import Flask, Response, jsonify, request
+from PIL import Image
+from werkzeug.serving import make_server
+
+# Import the app's packages from the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import db.database
+from db.connection import ConnectionManager
+from services.inference import FRAMES_MIME
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A fresh, migrated database behind db.database.get_connection()."""
+    connections = ConnectionManager(str(tmp_path / "test.db"))
+    monkeypatch.setattr(db.database, "connections", connections)
+    db.database.init_db()
+    yield connections
+    connections.close_all()
+
+
+class StubInference:
+    """An inference server on a local port, speaking the binary frame format.
+
+    `mode` decides how /generate answers: "ok" (images after a few progress
+    frames), "error" (HTTP 500) or "dropped" (an error frame, as when the
+    server gives up on a job past its deadline). Requests wait on `gate`
+    while it is cleared. /health fails while `healthy` is False.
+    """
+
+    def __init__(self):
+        self.mode = "ok"
+        self.healthy = True
+        self.delay = 0.0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.requests = []
+        app = Flask(__name__)
+        app.add_url_rule("/generate", view_func=self._generate, methods=["POST"])
+        app.add_url_rule("/health", view_func=self._health)
+        self._server = make_server("127.0.0.1", 0, app, threaded=True)
+        self.url = f"http://127.0.0.1:{self._server.server_port}/generate"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.gate.set()
+        self._server.shutdown()
+
+    def _health(self):
+        return (jsonify(ok=True), 200) if self.healthy else (jsonify(ok=False), 503)
+
+    def _generate(self):
+        payload = request.json
+        self.requests.append(payload)
+        self.gate.wait(10)
+        time.sleep(self.delay)
+        if self.mode == "error":
+            return jsonify(error="CUDA out of memory"), 500
+
+        def frame(data):
+            return struct.pack(">I", len(data)) + data
+
+        def frames():
+            yield frame(json.dumps({"type": "progress", "step": 1, "total": 1}).encode())
+            if self.mode == "dropped":
+                yield frame(json.dumps({"type": "error", "error": "Deadline passed"}).encode())
+                return
+            buffer = io.BytesIO()
+            Image.new("RGB", (8, 8), (len(payload["prompt"]), 0, 0)).save(buffer, "PNG")
+            yield frame(json.dumps({"type": "images", "count": 1}).encode())
+            yield frame(buffer.getvalue())
+
+        return Response(frames(), mimetype=FRAMES_MIME)
+
+
+@pytest.fixture
+def stub_factory():
+    """Start stub inference servers on demand; they are shut down afterwards."""
+    stubs = []
+
+    def start():
+        stub = StubInference()
+        stubs.append(stub)
+        return stub
+
+    yield start
+    for stub in stubs:
+        stub.close()
+
+
+@pytest.fixture
+def stub(stub_factory):
+    return stub_factory()
+
+
+def wait_until(condition, timeout=10, interval=0.05):
+    """Poll `condition()` until it is true; fail the test after `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return
+        time.sleep(interval)
+    raise AssertionError("Timed out waiting for condition")
+
@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+
+from services.batcher import GenerationCancelled, RequestBatcher
+
+
+class StubPipe:
+    """Stands in for StableDiffusionPipeline on CPU.
+
+    Runs its `steps` through the step callback, `step_delay` seconds each,
+    and returns one "image" per prompt: (prompt, generator). Every call's
+    keyword arguments are kept in `calls`; `started` is set on each call.
+    """
+
+    def __init__(self, step_delay=0.0):
+        self.step_delay = step_delay
+        self.calls = []
+        self.started = threading.Event()
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        self.started.set()
+        for step in range(kwargs["num_inference_steps"]):
+            time.sleep(self.step_delay)
+            kwargs["callback_on_step_end"](self, step, step, {})
+        generators = kwargs.get("generator") or [None] * len(kwargs["prompt"])
+        return type("Output", (), {"images": list(zip(kwargs["prompt"], generators))})
+
+
+def enqueue(batcher, prompt, width=512, num_images=2, **options):
+    return batcher.enqueue(prompt, "", width, 512, 7.5, 2, num_images=num_images, **options)
+
+
+def test_requests_with_the_same_settings_share_a_call():
+    pipe = StubPipe()
+    batcher = RequestBatcher(pipe, max_batch=8, max_wait=0.2)
+    square = [enqueue(batcher, "cat"), enqueue(batcher, "dog")]
+    wide = enqueue(batcher, "fox", width=768)
+
+    assert square[0].future.result(5) == [("cat", None)] * 2
+    assert square[1].future.result(5) == [("dog", None)] * 2
+    assert wide.future.result(5) == [("fox", None)] * 2
+    assert sorted(len(call["prompt"]) for call in pipe.calls) == [2, 4]
+    assert {call["width"] for call in pipe.calls} == {512, 768}
+
+
+def test_batches_hold_at_most_max_batch_images():
+    pipe = StubPipe()
+    batcher = RequestBatcher(pipe, max_batch=4, max_wait=0.2)
+    requests = [enqueue(batcher, prompt) for prompt in ("a", "b", "c")]
+
+    results = [req.future.result(5) for req in requests]
+    assert results == [[(prompt, None)] * 2 for prompt in ("a", "b", "c")]
+    assert [call["prompt"] for call in pipe.calls] == [["a", "a", "b", "b"], ["c", "c"]]
+
+
+def test_a_full_batch_does_not_wait_for_max_wait():
+    batcher = RequestBatcher(StubPipe(), max_batch=2, max_wait=5)
+    started = time.monotonic()
+    enqueue(batcher, "cat").future.result(5)
+    assert time.monotonic() - started < 1
+
+
+def test_a_lone_request_waits_max_wait_for_company():
+    batcher = RequestBatcher(StubPipe(), max_batch=8, max_wait=0.3)
+    started = time.monotonic()
+    enqueue(batcher, "cat").future.result(5)
+    assert time.monotonic() - started >= 0.3
+
+
+def test_seeded_requests_get_one_generator_per_image():
+    pipe = StubPipe()
+    batcher = RequestBatcher(pipe, max_batch=8, max_wait=0.2, make_generator=lambda seed: seed)
+    seeded = enqueue(batcher, "cat", seed=10, num_images=3)
+    unseeded = enqueue(batcher, "dog")
+
+    assert [generator for _, generator in seeded.future.result(5)] == [10, 11, 12]
+    first, second = [generator for _, generator in unseeded.future.result(5)]
+    assert second == first + 1
+
+
+def test_cancelling_a_queued_request_drops_it():
+    pipe = StubPipe()
+    batcher = RequestBatcher(pipe, max_batch=8, max_wait=0.3)
+    cancelled = enqueue(batcher, "cat", job_id="j1")
+    kept = enqueue(batcher, "dog", job_id="j2")
+    assert batcher.cancel("j1")
+
+    with pytest.raises(GenerationCancelled):
+        cancelled.future.result(5)
+    assert kept.future.result(5) == [("dog", None)] * 2
+    assert [call["prompt"] for call in pipe.calls] == [["dog", "dog"]]
+    assert not batcher.cancel("j1")
+
+
+def test_a_running_batch_finishes_for_the_requests_still_wanted():
+    pipe = StubPipe(step_delay=0.1)
+    batcher = RequestBatcher(pipe, max_batch=4, max_wait=0.1)
+    cancelled = enqueue(batcher, "cat", job_id="j1")
+    kept = enqueue(batcher, "dog", job_id="j2")
+    pipe.started.wait(5)
+    batcher.cancel("j1")
+
+    with pytest.raises(GenerationCancelled):
+        cancelled.future.result(5)
+    assert kept.future.result(5) == [("dog", None)] * 2
+
+
+def test_a_batch_nobody_wants_stops_at_the_next_step():
+    pipe = StubPipe(step_delay=0.2)
+    batcher = RequestBatcher(pipe, max_batch=2, max_wait=0)
+    req = batcher.enqueue("cat", "", 512, 512, 7.5, 50, num_images=2, job_id="j1")
+    pipe.started.wait(5)
+    started = time.monotonic()
+    batcher.cancel("j1")
+
+    with pytest.raises(GenerationCancelled):
+        req.future.result(5)
+    # The next request doesn't wait for the other 49 steps
+    enqueue(batcher, "dog").future.result(5)
+    assert time.monotonic() - started < 2
+
+
+def test_requests_past_their_deadline_time_out():
+    pipe = StubPipe(step_delay=0.2)
+    batcher = RequestBatcher(pipe, max_batch=2, max_wait=0)
+    # Keeps the pipeline busy while the next request's deadline passes in the queue
+    running = batcher.enqueue("slow", "", 512, 512, 7.5, 5, num_images=2, timeout=0.3)
+    queued = enqueue(batcher, "cat", timeout=0.1)
+
+    with pytest.raises(TimeoutError):
+        queued.future.result(5)
+    with pytest.raises(TimeoutError):
+        running.future.result(5)
+    assert [call["prompt"] for call in pipe.calls] == [["slow", "slow"]]
@@ -0,0 +1,193 @@
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+import requests
+
+import services.dispatcher
+from conftest import wait_until
+from db.database import get_connection
+from db.jobs import create_job, get_job
+from services.dispatcher import JobDispatcher
+from services.inference import JobDropped, endpoint_failed, fetch_images
+from services.router import CLOSED, OPEN, Backend, InferenceRouter
+
+UNREACHABLE = "http://127.0.0.1:9/generate"
+
+
+@pytest.fixture
+def run_dispatcher(database, tmp_path):
+    """Start a dispatcher over `urls` wired up like app.py's, minus the storage.
+
+    Deliveries finish `deliver_delay` seconds later from another thread,
+    the way the generation writer does. Returns (dispatcher, router, failed
+    jobs); every dispatcher is stopped at the end of the test.
+    """
+    started = []
+    spool = str(tmp_path / "spool")
+
+    def run(*urls, deliver_delay=0.0, **router_options):
+        router_options.setdefault("check_interval", 0)
+        router = InferenceRouter([Backend(url) for url in urls], **router_options)
+        failed = []
+        timers = []
+
+        def fetch(job, backend):
+            if job['deadline'] and job['deadline'] < time.time():
+                raise JobDropped("Job deadline passed before it reached the GPU")
+            payload = {"job_id": job['id'], "prompt": job['prompt'], "timeout": 5}
+            return fetch_images(backend.url, payload, spool, 5, http=backend.session)
+
+        def deliver(job, paths, finish, fail):
+            timer = threading.Timer(deliver_delay, finish, args=({"images": len(paths)},))
+            timers.append(timer)
+            timer.start()
+
+        def cleanup(paths):
+            for path in paths:
+                os.remove(path)
+
+        dispatcher = JobDispatcher(router, fetch, deliver, cleanup=cleanup,
+                                   on_failure=failed.append, poll_interval=0.05,
+                                   retry_on=(requests.ConnectionError,), blame=endpoint_failed)
+        dispatcher.timers = timers
+        dispatcher.start()
+        started.append(dispatcher)
+        return dispatcher, router, failed
+
+    yield run
+    for dispatcher in started:
+        dispatcher.stop()
+        for timer in dispatcher.timers:
+            timer.join()
+
+
+def status(job_id):
+    return get_job(job_id)['status']
+
+
+def queue(dispatcher, prompt="a cat", **options):
+    job_id = create_job(prompt, "square", **options)
+    dispatcher.notify()
+    return job_id
+
+
+def test_identical_requests_share_one_run(stub, run_dispatcher):
+    dispatcher, router, _ = run_dispatcher(stub.url)
+    stub.gate.clear()
+    leader = queue(dispatcher, request_key="k")
+    wait_until(lambda: len(stub.requests) == 1)
+    follower = queue(dispatcher, request_key="k")
+    assert status(follower) == "attached"
+
+    stub.gate.set()
+    wait_until(lambda: status(leader) == status(follower) == "done")
+    assert len(stub.requests) == 1
+
+
+def test_follower_attaching_during_delivery_is_not_stranded(stub, run_dispatcher):
+    dispatcher, router, _ = run_dispatcher(stub.url, deliver_delay=1.0)
+    leader = queue(dispatcher, request_key="k")
+    # The images are fetched and the delivery is pending: the leader is
+    # still running but no longer takes followers
+    wait_until(lambda: get_job(leader)['request_key'] is None)
+    assert status(leader) == "running"
+
+    late = queue(dispatcher, request_key="k")
+    wait_until(lambda: status(leader) == status(late) == "done")
+    assert len(stub.requests) == 2
+
+
+def test_followers_left_behind_by_a_finished_leader_run_on_their_own(stub, run_dispatcher):
+    dispatcher, router, _ = run_dispatcher(stub.url)
+    leader = queue(dispatcher)
+    wait_until(lambda: status(leader) == "done")
+
+    conn = get_connection()
+    conn.execute("""
+        INSERT INTO generation_jobs (id, prompt, aspect, status, leader_id)
+        VALUES ('orphan', 'a cat', 'square', 'attached', ?)
+    """, (leader,))
+    conn.commit()
+    conn.close()
+    dispatcher.notify()
+    wait_until(lambda: status('orphan') == "done")
+
+
+def test_expired_jobs_do_not_eject_the_endpoint(stub, run_dispatcher):
+    dispatcher, router, failed = run_dispatcher(stub.url, failure_threshold=3)
+    expired = [queue(dispatcher, prompt=f"cat {n}", deadline=time.time() - 1) for n in range(4)]
+    wait_until(lambda: all(status(job_id) == "failed" for job_id in expired))
+
+    (backend,) = router.backends
+    assert backend.state == CLOSED
+    assert backend.failures == 0
+    assert len(failed) == 4
+    assert stub.requests == []
+
+    job_id = queue(dispatcher)
+    wait_until(lambda: status(job_id) == "done")
+
+
+def test_server_dropping_jobs_does_not_eject_the_endpoint(stub, run_dispatcher):
+    dispatcher, router, _ = run_dispatcher(stub.url, failure_threshold=2)
+    stub.mode = "dropped"
+    dropped = [queue(dispatcher, prompt=f"cat {n}") for n in range(3)]
+    wait_until(lambda: all(status(job_id) == "failed" for job_id in dropped))
+    assert router.backends[0].state == CLOSED
+
+
+def test_failing_endpoint_is_ejected_then_readmitted(stub, run_dispatcher):
+    dispatcher, router, failed = run_dispatcher(stub.url, failure_threshold=2, cooldown=0.5)
+    (backend,) = router.backends
+    stub.mode = "error"
+    broken = [queue(dispatcher, prompt=f"cat {n}") for n in range(2)]
+    wait_until(lambda: all(status(job_id) == "failed" for job_id in broken))
+    assert backend.state == OPEN
+
+    stub.mode = "ok"
+    waiting = queue(dispatcher)
+    time.sleep(0.2)
+    # Still cooling down: the job waits in the queue
+    assert status(waiting) == "queued"
+    wait_until(lambda: status(waiting) == "done")
+    assert backend.state == CLOSED
+    assert backend.latency is not None
+
+
+def test_unreachable_endpoint_hands_its_job_to_another(stub, run_dispatcher):
+    dispatcher, router, failed = run_dispatcher(UNREACHABLE, stub.url,
+                                                failure_threshold=1, cooldown=0.3)
+    dead, alive = router.backends
+    # Keep the live endpoint out of rotation until the dead one had the job
+    with router._lock:
+        alive.state, alive.opened_at = OPEN, time.monotonic()
+    job_id = queue(dispatcher)
+    wait_until(lambda: status(job_id) == "done")
+    assert get_job(job_id)['backend'] == stub.url
+    assert dead.state == OPEN
+    assert alive.state == CLOSED
+    assert failed == []
+
+
+def test_worker_survives_a_database_error(stub, run_dispatcher, monkeypatch):
+    real = services.dispatcher.take_followers
+    calls = []
+
+    def locked_once(leader_id):
+        calls.append(leader_id)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return real(leader_id)
+
+    monkeypatch.setattr(services.dispatcher, "take_followers", locked_once)
+    dispatcher, router, failed = run_dispatcher(stub.url)
+    first = queue(dispatcher)
+    wait_until(lambda: status(first) == "failed")
+    assert [job['id'] for job in failed] == [first]
+
+    second = queue(dispatcher)
+    wait_until(lambda: status(second) == "done")
+    assert router.backends[0].in_flight == 0
@@ -0,0 +1,59 @@
+import os
+
+from PIL import Image
+
+from db.database import get_connection
+from services.image_store import ImageStore, file_digest
+from services.persistence import GenerationWriter
+
+
+def spool(tmp_path, name, color):
+    path = str(tmp_path / "spool" / name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new("RGB", (8, 8), color).save(path, "PNG")
+    return path, file_digest(path)
+
+
+def stored_files(static):
+    return sorted(name for _, _, files in os.walk(static) for name in files)
+
+
+def test_failed_job_leaves_nothing_in_the_store(database, tmp_path):
+    static = str(tmp_path / "static")
+    writer = GenerationWriter(ImageStore(static), str(tmp_path / "spool"))
+    good, bad = spool(tmp_path, "good.png", (255, 0, 0)), spool(tmp_path, "bad.png", (0, 255, 0))
+    outcomes = []
+
+    def row(path):
+        return (None, "a cat", ImageStore(static).relative_path(path[1]), "square", 8, 8)
+
+    writer._write([
+        ([good], [row(good)], lambda: outcomes.append("stored"), None),
+        # The row has a column too many, so the INSERT fails after the file moved
+        ([bad], [row(bad) + (1,)], None, lambda error: outcomes.append("failed")),
+    ])
+
+    assert outcomes == ["stored", "failed"]
+    assert stored_files(static) == [f"{good[1]}.png"]
+    assert os.listdir(tmp_path / "spool") == []
+    conn = get_connection()
+    assert conn.execute("SELECT hash FROM image_blobs").fetchall() == [(good[1],)]
+    conn.close()
+
+
+def test_failed_job_keeps_a_file_other_generations_share(database, tmp_path):
+    static = str(tmp_path / "static")
+    store = ImageStore(static)
+    writer = GenerationWriter(store, str(tmp_path / "spool"))
+    first = spool(tmp_path, "first.png", (0, 0, 255))
+    row = (None, "a cat", store.relative_path(first[1]), "square", 8, 8)
+    writer._write([([first], [row], None, None)])
+
+    again = spool(tmp_path, "again.png", (0, 0, 255))
+    writer._write([([again], [row + (1,)], None, None)])
+
+    assert stored_files(static) == [f"{first[1]}.png"]
+    assert os.listdir(tmp_path / "spool") == []
+    conn = get_connection()
+    assert conn.execute("SELECT refcount FROM image_blobs").fetchall() == [(1,)]
+    conn.close()
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+from PIL import Image
+
+from services.resizer import ImageResizer
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = str(tmp_path / "source.png")
+    Image.effect_noise((512, 512), 64).convert("RGB").save(path)
+    return path
+
+
+def test_evicted_output_is_rendered_again(source, tmp_path):
+    resizer = ImageResizer(str(tmp_path / "cache"))
+    path = resizer.get(source, 100, "png")
+    os.remove(path)
+
+    assert resizer.get(source, 100, "png") == path
+    assert os.path.isfile(path)
+
+
+def test_render_replaces_a_cached_output(source, tmp_path):
+    resizer = ImageResizer(str(tmp_path / "cache"))
+    path = resizer.get(source, 100, "png")
+    with open(path, "wb"):
+        pass
+
+    assert resizer.render(source, 100, "png") == path
+    assert os.path.getsize(path) > 0
+
+
+def test_processes_sharing_the_cache_stay_under_its_size(source, tmp_path):
+    cache = str(tmp_path / "cache")
+    first, second = ImageResizer(cache), ImageResizer(cache)
+    # Copies of one image, so every output has the same size
+    sources = []
+    for n in range(5):
+        path = str(tmp_path / f"copy-{n}.png")
+        os.link(source, path)
+        sources.append(path)
+    size = os.path.getsize(first.get(sources[0], 100, "png"))
+    first.max_bytes = second.max_bytes = 3 * size
+
+    for n, src in enumerate(sources[1:]):
+        (first, second)[n % 2].get(src, 100, "png")
+
+    assert len(os.listdir(cache)) == 3
+    # Whichever process evicted an output, the other renders it again on demand
+    assert os.path.isfile(second.get(sources[0], 100, "png"))
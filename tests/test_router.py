@@ -0,0 +1,117 @@
+import time
+
+import pytest
+import requests
+
+from services.inference import JobDropped, endpoint_failed, fetch_images
+from services.router import CLOSED, OPEN, Backend, InferenceRouter
+
+
+def make_router(*urls, **options):
+    options.setdefault("check_interval", 0)
+    return InferenceRouter([Backend(url) for url in urls], **options)
+
+
+def test_acquire_prefers_least_loaded_endpoint():
+    router = make_router("http://a/generate", "http://b/generate")
+    a, b = router.backends
+    a.latency, b.latency = 1.0, 3.0
+    a.concurrency = 4
+
+    # a wins (ties included) until its score, (in_flight + 1) * 1.0, passes b's 3.0
+    assert [router.acquire() for _ in range(4)] == [a, a, a, b]
+    assert router.acquire() is a    # b is full; a still has a free slot
+    assert router.acquire() is None
+
+
+def test_release_updates_moving_average_latency():
+    router = make_router("http://a/generate", latency_alpha=0.5)
+    backend = router.acquire()
+    router.release(backend, latency=2.0)
+    backend = router.acquire()
+    router.release(backend, latency=4.0)
+    assert backend.latency == 3.0
+    assert backend.in_flight == 0
+
+
+def test_failures_eject_then_trial_job_readmits():
+    router = make_router("http://a/generate", failure_threshold=3, cooldown=0.2)
+    (backend,) = router.backends
+
+    for _ in range(3):
+        router.release(router.acquire(), failed=True, error="boom")
+    assert backend.state == OPEN
+    assert router.acquire() is None
+
+    time.sleep(0.25)
+    trial = router.acquire()
+    assert trial is backend
+    # Only one trial job at a time while the circuit is open
+    assert router.acquire() is None
+    router.release(trial, latency=1.0)
+    assert backend.state == CLOSED
+    assert backend.failures == 0
+
+
+def test_failed_trial_keeps_endpoint_ejected():
+    router = make_router("http://a/generate", failure_threshold=3, cooldown=0.2)
+    (backend,) = router.backends
+    for _ in range(3):
+        router.release(router.acquire(), failed=True)
+
+    time.sleep(0.25)
+    router.release(router.acquire(), failed=True)
+    assert backend.state == OPEN
+    assert router.acquire() is None
+
+
+def test_unused_slot_does_not_affect_health():
+    router = make_router("http://a/generate", failure_threshold=1)
+    (backend,) = router.backends
+    router.release(router.acquire())
+    assert backend.state == CLOSED
+    assert backend.latency is None
+
+
+def test_health_checks_eject_and_readmit(stub):
+    router = make_router(stub.url, failure_threshold=2, cooldown=0.2)
+    (backend,) = router.backends
+
+    stub.healthy = False
+    assert not router.check(backend)
+    assert backend.state == CLOSED
+    assert not router.check(backend)
+    assert backend.state == OPEN
+
+    stub.healthy = True
+    # A passing check only readmits after the cooldown
+    assert router.check(backend)
+    assert backend.state == OPEN
+    time.sleep(0.25)
+    assert router.check(backend)
+    assert backend.state == CLOSED
+
+
+def test_endpoint_failed_blames_transport_and_server_errors(stub, tmp_path):
+    payload = {"job_id": "j", "prompt": "p"}
+
+    stub.mode = "error"
+    with pytest.raises(requests.HTTPError) as server_error:
+        fetch_images(stub.url, payload, str(tmp_path), timeout=5)
+    assert endpoint_failed(server_error.value)
+
+    with pytest.raises(requests.ConnectionError) as unreachable:
+        requests.post("http://127.0.0.1:9/generate", timeout=2)
+    assert endpoint_failed(unreachable.value)
+
+    not_found = requests.Response()
+    not_found.status_code = 404
+    assert not endpoint_failed(requests.HTTPError(response=not_found))
+
+
+def test_dropped_jobs_are_not_the_endpoints_fault(stub, tmp_path):
+    stub.mode = "dropped"
+    with pytest.raises(JobDropped) as dropped:
+        fetch_images(stub.url, {"job_id": "j", "prompt": "p"}, str(tmp_path), timeout=5)
+    assert not endpoint_failed(dropped.value)
+    assert not endpoint_failed(JobDropped("Job deadline passed before it reached the GPU"))